@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import gc
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+
+from malbeacon import C2Beacon, MalBeaconClient, MalBeaconParsingException, Metrics, RetryPolicy, EXPORTERS
+from mockserver import MockMalBeaconServer, SyntheticBeacons
+
+
+class LegacyC2Beacon:
+    """Former implementation of `C2Beacon` and its decoding, kept as baseline for the benchmarks."""
+
+    def __init__(self, response):
+        def value(key):
+            return None if MalBeaconClient.is_null(response[key]) else response[key]
+
+        def location(key):
+            return None if MalBeaconClient.is_null(response[key]) else LegacyGeoLocation.from_string(response[key])
+
+        self.timestamp = datetime.datetime.strptime(response['tstamp'], '%Y-%m-%d %H:%M:%S')
+        self.actor_asn_organization = value('actorasnorg')
+        self.actor_city = value('actorcity')
+        self.actor_country_code = value('actorcountrycode')
+        self.actor_hostname = value('actorhostname')
+        self.actor_ip = value('actorip')
+        self.actor_location = location('actorloc')
+        self.actor_region = value('actorregion')
+        self.actor_timezone = value('actortimezone')
+        self.c2 = value('c2')
+        self.c2_asn_organization = value('c2asnorg')
+        self.c2_city = value('c2city')
+        self.c2_country_code = value('c2countrycode')
+        self.c2_domain = value('c2domain')
+        self.c2_domain_resolved = value('c2domainresolved')
+        self.c2_hostname = value('c2hostname')
+        self.c2_location = location('c2loc')
+        self.c2_region = value('c2region')
+        self.c2_timezone = value('c2timezone')
+        self.cookie_id = LegacyValue(response['cookie_id'])
+        self.user_agent = value('useragent')
+        self.tags = [] if MalBeaconClient.is_null(response['tags']) else [LegacyValue(response['tags'])]
+
+
+class LegacyGeoLocation:
+    def __init__(self, latitude: int, longitude: int):
+        self.latitude = latitude
+        self.longitude = longitude
+
+    @staticmethod
+    def from_string(s):
+        m = re.match(r'^(-?\d+(?:\.\d{4})?),\s*(-?\d+(?:\.\d{4})?)$', s)
+        if not m:
+            raise MalBeaconParsingException(F'Invalid GeoLocation: {s}')
+        return LegacyGeoLocation(int(m.group(1).replace('.', ''), 10), int(m.group(2).replace('.', ''), 10))
+
+
+class LegacyValue:
+    def __init__(self, value):
+        self.value = value
+
+
+def bytes_per_beacon(body: bytes, count: int, decode) -> float:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        lines = json.loads(body)
+        beacons = [decode(line) for line in lines]
+        del lines
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(beacons) == count
+    return float(current - baseline) / count
+
+
+def benchmark_memory(args):
+    body = SyntheticBeacons(args.seed).body(args.count)
+    before = bytes_per_beacon(body, args.count, LegacyC2Beacon)
+    after = bytes_per_beacon(body, args.count, C2Beacon.from_response_line)
+    print(F'Retained memory of {args.count} beacons:')
+    print(F'    before (dict-based, not interned): {before:8.0f} bytes/beacon')
+    print(F'    after (slots, interned):           {after:8.0f} bytes/beacon ({after / before:.0%})')
+
+
+def records_per_second(lines: typing.List[dict], decode, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            decode(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def benchmark_decode(args):
+    lines = json.loads(SyntheticBeacons(args.seed).body(args.count))
+    before = records_per_second(lines, LegacyC2Beacon, args.repeat)
+    after = records_per_second(lines, C2Beacon.from_response_line, args.repeat)
+    print(F'Decoding {args.count} response lines (best of {args.repeat}):')
+    print(F'    before (per-field is_null, strptime): {before:10.0f} records/s')
+    print(F'    after (table-driven, lazy locations): {after:10.0f} records/s ({after / before:.1f}x)')
+
+
+def percentile(values: typing.List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def peak_rss() -> str:
+    try:
+        import resource
+    except ImportError:
+        return 'n/a'
+    # kilobytes on Linux, bytes on macOS
+    return F'{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB'
+
+
+def report(title: str, count: int, elapsed: float, latencies: typing.List[float] = None, errors: int = 0):
+    print(F'{title}: {count} in {elapsed:.2f}s, {count / elapsed:.1f}/s, {errors} errors')
+    if latencies:
+        print('    latency: ' + ', '.join(
+            F'p{int(fraction * 100)} {percentile(latencies, fraction) * 1000:.1f}ms'
+            for fraction in (0.5, 0.9, 0.99)
+        ))
+    print(F'    peak RSS: {peak_rss()}')
+
+
+def mock_server(args) -> MockMalBeaconServer:
+    return MockMalBeaconServer(
+        min_size=args.size, max_size=args.size, latency=args.latency, no_results_rate=args.error_rate / 4,
+        quota_rate=args.error_rate / 4, server_error_rate=args.error_rate / 2, seed=args.seed,
+    )
+
+
+class LatencyRecorder(Metrics):
+    """Keeps every request latency instead of histogram buckets only, for exact percentiles."""
+
+    def __init__(self):
+        super().__init__()
+        self.latencies = []
+
+    def observe(self, endpoint: str, latency: float):
+        super().observe(endpoint, latency)
+        self.latencies.append(latency)
+
+
+def mock_client(server: MockMalBeaconServer, workers: int = 1, metrics: Metrics = None) -> MalBeaconClient:
+    return MalBeaconClient(
+        'benchmark', 'MalBeaconBenchmark', server.base_url, pool_size=max(workers, 10),
+        retry_policy=RetryPolicy(backoff=0.01, max_backoff=0.1), metrics=metrics,
+    )
+
+
+def timed_lookup(client: MalBeaconClient, value: str) -> typing.Tuple[float, bool]:
+    start = time.perf_counter()
+    try:
+        client.by_cookie_id(value)
+        ok = True
+    except Exception:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def benchmark_single(args):
+    with mock_server(args) as server:
+        client = mock_client(server)
+        start = time.perf_counter()
+        results = [timed_lookup(client, F'cookie{i}') for i in range(args.count)]
+        elapsed = time.perf_counter() - start
+    report(
+        F'Sequential lookups of {args.size} beacons', args.count, elapsed, [latency for latency, _ in results],
+        sum(1 for _, ok in results if not ok)
+    )
+
+
+def benchmark_bulk(args):
+    metrics = LatencyRecorder()
+    with mock_server(args) as server:
+        client = mock_client(server, args.workers, metrics)
+        start = time.perf_counter()
+        values = (F'cookie{i}' for i in range(args.count))
+        results = list(client.lookup_many('cookie', values, workers=args.workers))
+        elapsed = time.perf_counter() - start
+    # latencies of the requests (until the response headers arrived), lookup_many does not time single lookups
+    report(
+        F'lookup_many of {args.size} beacons with {args.workers} workers', args.count, elapsed, metrics.latencies,
+        sum(1 for result in results if not result.ok)
+    )
+
+
+def benchmark_export(args):
+    lines = json.loads(SyntheticBeacons(args.seed).body(args.count))
+    for name, exporter_class in EXPORTERS.items():
+        beacons = [C2Beacon.from_response_line(line) for line in lines]
+        try:
+            exporter = exporter_class(open(os.devnull, 'wb'))
+        except Exception as e:
+            print(F'Export to {name}: skipped ({e})')
+            continue
+        start = time.perf_counter()
+        with exporter:
+            exporter.write_many(beacons)
+        report(F'Export to {name}', args.count, time.perf_counter() - start)
+
+
+def startup_times(command: typing.List[str], repeat: int) -> typing.List[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def supports(script: str, flags: typing.List[str]) -> bool:
+    """Whether the CLI of the given version of malbeacon.py knows all of the given global flags."""
+    usage = subprocess.run([sys.executable, script, '--help'], stdout=subprocess.PIPE, check=True).stdout.decode()
+    return all(re.search(F'{re.escape(flag)}\\b', usage) for flag in flags)
+
+
+def benchmark_startup(args):
+    scripts = [('current', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'malbeacon.py'))]
+    if args.baseline:
+        scripts.insert(0, ('baseline', args.baseline))
+    with tempfile.TemporaryDirectory() as directory, MockMalBeaconServer(min_size=20, max_size=20) as server:
+        cache = os.path.join(directory, 'cache.sqlite')
+        common = ['--api-key', 'benchmark', '--base-url', server.base_url, '--cache-file', cache, '--no-store']
+        # fill the cache, so the measured lookups are answered without a request like most repeated lookups
+        subprocess.run(
+            [sys.executable, scripts[-1][1]] + common + ['cookie', 'benchmark'], stdout=subprocess.DEVNULL, check=True
+        )
+        print(F'Wall time of {args.repeat} CLI starts (median/min):')
+        scenarios = (('--help', ['--help']), ('cached lookup', common + ['--offline', 'cookie', 'benchmark']))
+        for title, arguments in scenarios:
+            for name, script in scripts:
+                # versions without a response cache cannot answer lookups offline
+                if not supports(script, [argument for argument in arguments if argument.startswith('--')]):
+                    print(F'    {title:14} {name:9} not supported')
+                    continue
+                times = startup_times([sys.executable, script] + arguments, args.repeat)
+                print(F'    {title:14} {name:9} {statistics.median(times) * 1000:6.1f} ms {min(times) * 1000:6.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    memory_parser = subparsers.add_parser('memory', help='Compare the memory used per decoded beacon.')
+    memory_parser.add_argument('--count', type=int, default=100000)
+
+    decode_parser = subparsers.add_parser('decode', help='Measure how many response lines are decoded per second.')
+    decode_parser.add_argument('--count', type=int, default=100000)
+    decode_parser.add_argument('--repeat', type=int, default=5)
+
+    single_parser = subparsers.add_parser('single', help='Sequential lookups against a local mock server.')
+    single_parser.add_argument('--count', type=int, default=200)
+
+    bulk_parser = subparsers.add_parser('bulk', help='Concurrent lookups against a local mock server.')
+    bulk_parser.add_argument('--count', type=int, default=1000)
+    bulk_parser.add_argument('--workers', type=int, default=16)
+
+    export_parser = subparsers.add_parser('export', help='Measure how many beacons are exported per second.')
+    export_parser.add_argument('--count', type=int, default=100000)
+
+    startup_parser = subparsers.add_parser('startup', help='Measure how long the CLI takes to start.')
+    startup_parser.add_argument('--repeat', type=int, default=20)
+    startup_parser.add_argument(
+        '--baseline', help='Another version of malbeacon.py to compare with, e.g. extracted with "git show".'
+    )
+
+    for lookup_parser in (single_parser, bulk_parser):
+        lookup_parser.add_argument('--size', type=int, default=100, help='Number of beacons per response.')
+        lookup_parser.add_argument('--latency', type=float, default=0.01, help='Seconds the server delays responses.')
+        lookup_parser.add_argument(
+            '--error-rate', type=float, default=0, help='Share of 400 (No Results), 429 and 500 responses.'
+        )
+
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    {
+        'memory': benchmark_memory,
+        'decode': benchmark_decode,
+        'single': benchmark_single,
+        'bulk': benchmark_bulk,
+        'export': benchmark_export,
+        'startup': benchmark_startup,
+    }[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,55 @@
 #!/usr/bin/env python3
-import argparse
-import logging
+# only cheap modules are imported here, everything else (requests above all) is imported where it is needed, as the
+# CLI is started for single lookups, which are often answered from the cache without any request
 import typing
 import json
+import logging
 import os
 import re
+import io
+import sys
+import array
+import collections
+import functools
+import operator
+import codecs
+import time
+import threading
 import datetime
 from urllib.parse import quote as url_quote
 
-import requests
-import requests.adapters
-
 __version__ = '1.0.0'
 
 
-class FixedTimeoutAdapter(requests.adapters.HTTPAdapter):
-    def send(self, *pargs, **kwargs):
-        if kwargs['timeout'] is None:
-            kwargs['timeout'] = 5
-        return super(FixedTimeoutAdapter, self).send(*pargs, **kwargs)
+@functools.lru_cache(maxsize=None)
+def _fixed_timeout_adapter() -> type:
+    """Defines the requests adapter applying a default timeout on first use, as it requires importing requests."""
+    import requests.adapters
+
+    class FixedTimeoutAdapter(requests.adapters.HTTPAdapter):
+        def __init__(self, timeout=5, **kwargs):
+            self.timeout = timeout
+            super(FixedTimeoutAdapter, self).__init__(**kwargs)
+
+        def send(self, *pargs, **kwargs):
+            if kwargs['timeout'] is None:
+                kwargs['timeout'] = self.timeout
+            return super(FixedTimeoutAdapter, self).send(*pargs, **kwargs)
+
+    return FixedTimeoutAdapter
+
+
+def __getattr__(name):
+    # keeps "from malbeacon import FixedTimeoutAdapter" working without importing requests along with the module
+    if name == 'FixedTimeoutAdapter':
+        return _fixed_timeout_adapter()
+    raise AttributeError(F'module {__name__!r} has no attribute {name!r}')
 
 
 class DateTimeFactory:
     @staticmethod
     def to_str(dt: datetime) -> str:
-        return dt.strftime('%Y-%m-%d %H:%M:%S')
+        return dt.isoformat(' ', 'seconds')
 
     @staticmethod
     def to_date_str(dt: datetime) -> str:
@@ -36,6 +61,12 @@ class DateTimeFactory:
 
     @staticmethod
     def from_str(s: str) -> datetime:
+        if len(s) == 19:
+            # fromisoformat is implemented in C and an order of magnitude faster than strptime
+            try:
+                return datetime.datetime.fromisoformat(s)
+            except ValueError:
+                pass
         return datetime.datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
 
 
@@ -50,6 +81,12 @@ class MalBeaconException(Exception):
     pass
 
 
+class ConsoleHandler(logging.Handler):
+    def emit(self, record):
+        # stdout is reserved for results, which may be piped into other tools
+        print('[%s] %s' % (record.levelname, record.msg), file=sys.stderr)
+
+
 class Printer:
     @staticmethod
     def histogram(data, target_width=80 - 10):
@@ -60,6 +97,19 @@ class Printer:
                 bar = 'o' * width
                 print(F'{key:2}: {bar} ({data[key]})')
 
+    @staticmethod
+    def summary(frame):
+        Printer.list('User-Agents', frame.top('user_agent'))
+        Printer.list('C2 ASNs', frame.top('c2_asn_organization'))
+        Printer.list('Actor ASNs', frame.top('actor_asn_organization'))
+        Printer.list('Tags', frame.top('tag'))
+        if len(frame):
+            print(F'First Active: {DateTimeFactory.to_str(frame.min_timestamp())}')
+            print(F'Last Active: {DateTimeFactory.to_str(frame.max_timestamp())}')
+            print('')
+            print('Time of day histogram:')
+            Printer.histogram(frame.hour_histogram())
+
     @staticmethod
     def list(title, lst, limit=5):
         if lst:
@@ -101,6 +151,8 @@ class MalBeaconParsingException(MalBeaconException):
 
 
 class CookieId:
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -109,6 +161,8 @@ class CookieId:
 
 
 class CountryCode:
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -121,30 +175,7 @@ class CustomJsonEncoder(json.JSONEncoder):
         if isinstance(o, datetime.datetime):
             return DateTimeFactory.to_str(o)
         elif isinstance(o, C2Beacon):
-            return {
-                'timestamp': o.timestamp,
-                'actor_asn_organization': o.actor_asn_organization,
-                'actor_city': o.actor_city,
-                'actor_country_code': o.actor_country_code,
-                'actor_hostname': o.actor_hostname,
-                'actor_ip': o.actor_ip,
-                'actor_location': o.actor_location,
-                'actor_region': o.actor_region,
-                'actor_timezone': o.actor_timezone,
-                'c2': o.c2,
-                'c2_asn_organization': o.c2_asn_organization,
-                'c2_city': o.c2_city,
-                'c2_country_code': o.c2_country_code,
-                'c2_domain': o.c2_domain,
-                'c2_domain_resolved': o.c2_domain_resolved,
-                'c2_hostname': o.c2_hostname,
-                'c2_location': o.c2_location,
-                'c2_region': o.c2_region,
-                'c2_timezone': o.c2_timezone,
-                'cookie_id': o.cookie_id,
-                'user_agent': o.user_agent,
-                'tags': o.tags,
-            }
+            return o.to_dict()
         elif isinstance(o, GeoLocation):
             return {'latitude': o.latitude, 'longitude': o.longitude}
         elif isinstance(o, CookieId):
@@ -156,6 +187,10 @@ class CustomJsonEncoder(json.JSONEncoder):
 
 
 class GeoLocation:
+    __slots__ = ('latitude', 'longitude')
+    # matches on geo-location with 4 digits precision
+    PATTERN = re.compile(r'^(-?\d+(?:\.\d{4})?),\s*(-?\d+(?:\.\d{4})?)$')
+
     def __init__(self, latitude: int, longitude: int):
         self.latitude = latitude
         self.longitude = longitude
@@ -163,8 +198,7 @@ class GeoLocation:
     @staticmethod
     def from_string(s):
         assert s is not None
-        # regex that matches on geo-location with 4 digits precision
-        m = re.match(r'^(-?\d+(?:\.\d{4})?),\s*(-?\d+(?:\.\d{4})?)$', s)
+        m = GeoLocation.PATTERN.match(s)
         if not m:
             raise MalBeaconParsingException(F'Invalid GeoLocation: {s}')
         return GeoLocation(
@@ -177,6 +211,8 @@ class GeoLocation:
 
 
 class Timezone:
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -185,6 +221,8 @@ class Timezone:
 
 
 class Tag:
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -193,6 +231,40 @@ class Tag:
 
 
 class C2Beacon:
+    __slots__ = (
+        'timestamp', 'actor_asn_organization', 'actor_city', 'actor_country_code', 'actor_hostname', 'actor_ip',
+        '_actor_location', 'actor_region', 'actor_timezone', 'c2', 'c2_asn_organization', 'c2_city', 'c2_country_code',
+        'c2_domain', 'c2_domain_resolved', 'c2_hostname', '_c2_location', 'c2_region', 'c2_timezone', 'cookie_id',
+        'user_agent', 'tags',
+    )
+    # response keys of all plain string fields and the attributes they are decoded into
+    STRING_FIELDS = (
+        ('actorasnorg', 'actor_asn_organization'),
+        ('actorcity', 'actor_city'),
+        ('actorcountrycode', 'actor_country_code'),
+        ('actorhostname', 'actor_hostname'),
+        ('actorip', 'actor_ip'),
+        ('actorregion', 'actor_region'),
+        ('actortimezone', 'actor_timezone'),
+        ('c2', 'c2'),
+        ('c2asnorg', 'c2_asn_organization'),
+        ('c2city', 'c2_city'),
+        ('c2countrycode', 'c2_country_code'),
+        ('c2domain', 'c2_domain'),
+        ('c2domainresolved', 'c2_domain_resolved'),
+        ('c2hostname', 'c2_hostname'),
+        ('c2region', 'c2_region'),
+        ('c2timezone', 'c2_timezone'),
+        ('useragent', 'user_agent'),
+    )
+    # public attributes in the order of to_dict
+    FIELDS = (
+        'timestamp', 'actor_asn_organization', 'actor_city', 'actor_country_code', 'actor_hostname', 'actor_ip',
+        'actor_location', 'actor_region', 'actor_timezone', 'c2', 'c2_asn_organization', 'c2_city', 'c2_country_code',
+        'c2_domain', 'c2_domain_resolved', 'c2_hostname', 'c2_location', 'c2_region', 'c2_timezone', 'cookie_id',
+        'user_agent', 'tags',
+    )
+
     def __init__(self, timestamp: datetime, actor_asn_organization: str, actor_city: str,
                  actor_country_code: CountryCode, actor_hostname: str, actor_ip: str, actor_location: GeoLocation,
                  actor_region: str, actor_timezone: Timezone, c2: str, c2_asn_organization: str, c2_city: str,
@@ -205,7 +277,7 @@ class C2Beacon:
         self.actor_country_code = actor_country_code
         self.actor_hostname = actor_hostname
         self.actor_ip = actor_ip
-        self.actor_location = actor_location
+        self._actor_location = actor_location
         self.actor_region = actor_region
         self.actor_timezone = actor_timezone
         self.c2 = c2
@@ -215,192 +287,2636 @@ class C2Beacon:
         self.c2_domain = c2_domain
         self.c2_domain_resolved = c2_domain_resolved
         self.c2_hostname = c2_hostname
-        self.c2_location = c2_location
+        self._c2_location = c2_location
         self.c2_region = c2_region
         self.c2_timezone = c2_timezone
         self.cookie_id = cookie_id
         self.user_agent = user_agent
         self.tags = tags
 
+    # locations are kept as raw strings by from_response_line and only parsed once they are actually accessed
+    @property
+    def actor_location(self) -> typing.Optional[GeoLocation]:
+        if self._actor_location.__class__ is str:
+            self._actor_location = GeoLocation.from_string(self._actor_location)
+        return self._actor_location
+
+    @actor_location.setter
+    def actor_location(self, value: GeoLocation):
+        self._actor_location = value
+
+    @property
+    def c2_location(self) -> typing.Optional[GeoLocation]:
+        if self._c2_location.__class__ is str:
+            self._c2_location = GeoLocation.from_string(self._c2_location)
+        return self._c2_location
+
+    @c2_location.setter
+    def c2_location(self, value: GeoLocation):
+        self._c2_location = value
+
     @staticmethod
     def from_response_line(response):
-        return C2Beacon(
-            DateTimeFactory.from_str(response["tstamp"]),
-            None if MalBeaconClient.is_null(response["actorasnorg"]) else response["actorasnorg"],
-            None if MalBeaconClient.is_null(response["actorcity"]) else response["actorcity"],
-            None if MalBeaconClient.is_null(response["actorcountrycode"]) else response["actorcountrycode"],
-            None if MalBeaconClient.is_null(response["actorhostname"]) else response["actorhostname"],
-            None if MalBeaconClient.is_null(response["actorip"]) else response["actorip"],
-            None if MalBeaconClient.is_null(response["actorloc"]) else GeoLocation.from_string(response["actorloc"]),
-            None if MalBeaconClient.is_null(response["actorregion"]) else response["actorregion"],
-            None if MalBeaconClient.is_null(response["actortimezone"]) else response["actortimezone"],
-            None if MalBeaconClient.is_null(response["c2"]) else response["c2"],
-            None if MalBeaconClient.is_null(response["c2asnorg"]) else response["c2asnorg"],
-            None if MalBeaconClient.is_null(response["c2city"]) else response["c2city"],
-            None if MalBeaconClient.is_null(response["c2countrycode"]) else response["c2countrycode"],
-            None if MalBeaconClient.is_null(response["c2domain"]) else response["c2domain"],
-            None if MalBeaconClient.is_null(response["c2domainresolved"]) else response["c2domainresolved"],
-            None if MalBeaconClient.is_null(response["c2hostname"]) else response["c2hostname"],
-            None if MalBeaconClient.is_null(response["c2loc"]) else GeoLocation.from_string(response["c2loc"]),
-            None if MalBeaconClient.is_null(response["c2region"]) else response["c2region"],
-            None if MalBeaconClient.is_null(response["c2timezone"]) else response["c2timezone"],
-            CookieId(response["cookie_id"]),
-            None if MalBeaconClient.is_null(response["useragent"]) else response["useragent"],
-            [] if MalBeaconClient.is_null(response["tags"]) else [Tag(response["tags"])],
-        )
+        beacon = C2Beacon.__new__(C2Beacon)
+        beacon.timestamp = DateTimeFactory.from_str(response['tstamp'])
+        # values repeat a lot across records, interning them lets large result sets share a single copy of each
+        intern = sys.intern
+        for key, set_attribute in C2Beacon.STRING_SETTERS:
+            value = response[key]
+            set_attribute(beacon, None if value is None or value == 'NA' else intern(value))
+        value = response['actorloc']
+        beacon._actor_location = None if value is None or value == 'NA' else value
+        value = response['c2loc']
+        beacon._c2_location = None if value is None or value == 'NA' else value
+        value = response['cookie_id']
+        beacon.cookie_id = None if value is None or value == 'NA' else CookieId(intern(value))
+        value = response['tags']
+        beacon.tags = [] if value is None or value == 'NA' else [Tag(intern(value))]
+        return beacon
+
+    def to_dict(self) -> dict:
+        """Plain representation as serialized by `CustomJsonEncoder`, built without any further encoder callbacks."""
+        actor_location, c2_location = self.actor_location, self.c2_location
+        return {
+            'timestamp': DateTimeFactory.to_str(self.timestamp) if self.timestamp else None,
+            'actor_asn_organization': self.actor_asn_organization,
+            'actor_city': self.actor_city,
+            'actor_country_code': self.actor_country_code,
+            'actor_hostname': self.actor_hostname,
+            'actor_ip': self.actor_ip,
+            'actor_location': {'latitude': actor_location.latitude, 'longitude': actor_location.longitude}
+            if actor_location else None,
+            'actor_region': self.actor_region,
+            'actor_timezone': self.actor_timezone,
+            'c2': self.c2,
+            'c2_asn_organization': self.c2_asn_organization,
+            'c2_city': self.c2_city,
+            'c2_country_code': self.c2_country_code,
+            'c2_domain': self.c2_domain,
+            'c2_domain_resolved': self.c2_domain_resolved,
+            'c2_hostname': self.c2_hostname,
+            'c2_location': {'latitude': c2_location.latitude, 'longitude': c2_location.longitude}
+            if c2_location else None,
+            'c2_region': self.c2_region,
+            'c2_timezone': self.c2_timezone,
+            'cookie_id': str(self.cookie_id) if self.cookie_id else None,
+            'user_agent': self.user_agent,
+            'tags': [str(tag) for tag in self.tags] if self.tags is not None else None,
+        }
+
+    def fingerprint(self) -> str:
+        """Stable hash over all fields, identifying the same record across several responses."""
+        import hashlib
+
+        values = [
+            DateTimeFactory.to_str(self.timestamp) if self.timestamp else None,
+            str(self.cookie_id) if self.cookie_id else None,
+        ]
+        values.extend(getattr(self, attribute) for _, attribute in self.STRING_FIELDS)
+        for location in (self.actor_location, self.c2_location):
+            values.append([location.latitude, location.longitude] if location else None)
+        values.append([tag.value for tag in self.tags] if self.tags is not None else None)
+        return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def from_dict(values: dict) -> 'C2Beacon':
+        """Inverse of `to_dict`, missing fields are left None."""
+        beacon = C2Beacon.__new__(C2Beacon)
+        value = values.get('timestamp')
+        beacon.timestamp = DateTimeFactory.from_str(value) if value else None
+        intern = sys.intern
+        for _, attribute in C2Beacon.STRING_FIELDS:
+            value = values.get(attribute)
+            setattr(beacon, attribute, None if value is None else intern(value))
+        for attribute in ('actor_location', 'c2_location'):
+            value = values.get(attribute)
+            setattr(beacon, attribute, GeoLocation(value['latitude'], value['longitude']) if value else None)
+        value = values.get('cookie_id')
+        beacon.cookie_id = CookieId(intern(value)) if value else None
+        value = values.get('tags')
+        beacon.tags = [Tag(tag) for tag in value] if value is not None else None
+        return beacon
 
     def __repr__(self):
-        return F'<{self.__class__.__name__} {DateTimeFactory.to_str(self.timestamp)} ' \
+        timestamp = DateTimeFactory.to_str(self.timestamp) if self.timestamp else None
+        return F'<{self.__class__.__name__} {timestamp} ' \
                F'{self.actor_ip} {self.c2} {self.cookie_id} {self.user_agent}' \
                F'>'
 
 
+# slot descriptors of the plain string fields, calling them directly is cheaper than setattr in from_response_line
+C2Beacon.STRING_SETTERS = tuple(
+    (key, getattr(C2Beacon, attribute).__set__) for key, attribute in C2Beacon.STRING_FIELDS
+)
+
+
+class BeaconQuery:
+    """
+    Projection and filters applied while decoding response lines. Lines with a timestamp outside of [`since`, `until`)
+    or rejected by `predicate`, which is called with the raw response line, are dropped before any `C2Beacon` is
+    built. If `fields` is given, only these attributes are decoded and all others are left None.
+    """
+    TIMESTAMP_BOUND = re.compile(r'^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2})?$')
+    # response keys of the attributes a predicate can be built from with `equals`
+    KEYS = dict([(attribute, key) for key, attribute in C2Beacon.STRING_FIELDS] + [
+        ('cookie_id', 'cookie_id'),
+        ('tags', 'tags'),
+    ])
+
+    def __init__(self, fields: typing.Iterable[str] = None, since=None, until=None,
+                 predicate: typing.Callable[[dict], bool] = None):
+        if fields is not None:
+            fields = set(fields)
+            unknown = fields.difference(C2Beacon.FIELDS)
+            if unknown:
+                raise MalBeaconException(F'Unknown fields: {", ".join(sorted(unknown))}')
+            fields = tuple(field for field in C2Beacon.FIELDS if field in fields)
+        self.fields = fields
+        self.since = self.timestamp_bound(since)
+        self.until = self.timestamp_bound(until)
+        self.predicate = predicate
+
+        selected = C2Beacon.FIELDS if fields is None else fields
+        self._string_setters = tuple(
+            (key, setter) for (key, setter), (_, attribute) in zip(C2Beacon.STRING_SETTERS, C2Beacon.STRING_FIELDS)
+            if attribute in selected
+        )
+        self._unset_setters = tuple(
+            setter for (_, setter), (_, attribute) in zip(C2Beacon.STRING_SETTERS, C2Beacon.STRING_FIELDS)
+            if attribute not in selected
+        )
+        self._timestamp = 'timestamp' in selected
+        self._actor_location = 'actor_location' in selected
+        self._c2_location = 'c2_location' in selected
+        self._cookie_id = 'cookie_id' in selected
+        self._tags = 'tags' in selected
+
+    @staticmethod
+    def timestamp_bound(value) -> typing.Optional[str]:
+        """Normalizes a datetime, date or string bound to a string comparable with raw response timestamps."""
+        if value is None:
+            return None
+        if isinstance(value, datetime.datetime):
+            return DateTimeFactory.to_str(value)
+        if isinstance(value, datetime.date):
+            return DateTimeFactory.to_date_str(value)
+        if not BeaconQuery.TIMESTAMP_BOUND.match(value):
+            raise MalBeaconException(F'Invalid timestamp, expected "YYYY-MM-DD[ HH:MM:SS]": {value}')
+        return value
+
+    @staticmethod
+    def equals(**values) -> typing.Callable[[dict], bool]:
+        """Predicate accepting the lines whose attributes have the given values, e.g. `equals(c2_country_code='RU')`."""
+        unknown = set(values).difference(BeaconQuery.KEYS)
+        if unknown:
+            raise MalBeaconException(F'Cannot filter on: {", ".join(sorted(unknown))}')
+        conditions = tuple((BeaconQuery.KEYS[attribute], value) for attribute, value in values.items())
+        # a partial instead of a closure, so the predicate can be passed to worker processes
+        return functools.partial(BeaconQuery._matches, conditions)
+
+    @staticmethod
+    def _matches(conditions: typing.Tuple[typing.Tuple[str, str], ...], line: dict) -> bool:
+        return all(line[key] == value for key, value in conditions)
+
+    @property
+    def key(self) -> tuple:
+        return self.fields, self.since, self.until, self.predicate
+
+    def decode(self, line: dict) -> typing.Optional[C2Beacon]:
+        """Builds the beacon of a response line or returns None if the line is filtered out."""
+        timestamp = line['tstamp']
+        if self.since is not None and timestamp < self.since or self.until is not None and timestamp >= self.until:
+            return None
+        if self.predicate is not None and not self.predicate(line):
+            return None
+        if self.fields is None:
+            return C2Beacon.from_response_line(line)
+
+        beacon = C2Beacon.__new__(C2Beacon)
+        beacon.timestamp = DateTimeFactory.from_str(timestamp) if self._timestamp else None
+        intern = sys.intern
+        for key, set_attribute in self._string_setters:
+            value = line[key]
+            set_attribute(beacon, None if value is None or value == 'NA' else intern(value))
+        for set_attribute in self._unset_setters:
+            set_attribute(beacon, None)
+        value = line['actorloc'] if self._actor_location else None
+        beacon._actor_location = None if value is None or value == 'NA' else value
+        value = line['c2loc'] if self._c2_location else None
+        beacon._c2_location = None if value is None or value == 'NA' else value
+        value = line['cookie_id'] if self._cookie_id else None
+        beacon.cookie_id = None if value is None or value == 'NA' else CookieId(intern(value))
+        if self._tags:
+            value = line['tags']
+            beacon.tags = [] if value is None or value == 'NA' else [Tag(intern(value))]
+        else:
+            beacon.tags = None
+        return beacon
+
+
+class BeaconFrame:
+    """
+    Columnar container for large result sets: timestamps are kept as an array of seconds since the epoch and the
+    categorical columns as arrays of integer codes into per-column category lists. Aggregations of large frames run
+    on NumPy if it is installed and fall back to plain arrays otherwise.
+    """
+    COLUMNS = (
+        'cookie_id', 'actor_ip', 'actor_asn_organization', 'actor_country_code', 'c2', 'c2_asn_organization',
+        'c2_country_code', 'c2_domain', 'user_agent', 'tag',
+    )
+    EPOCH = datetime.datetime(1970, 1, 1)
+    # below this many rows, importing NumPy takes longer than aggregating the plain arrays
+    NUMPY_MIN_ROWS = 100000
+
+    def __init__(self):
+        self.timestamps = array.array('d')
+        self.codes = {column: array.array('l') for column in self.COLUMNS}
+        self.categories = {column: [] for column in self.COLUMNS}
+        self._category_codes = {column: {} for column in self.COLUMNS}
+
+    @staticmethod
+    def from_beacons(beacons: typing.Iterable[C2Beacon]) -> 'BeaconFrame':
+        frame = BeaconFrame()
+        frame.extend(beacons)
+        return frame
+
+    def _numpy(self):
+        if len(self) < self.NUMPY_MIN_ROWS:
+            return None
+        try:
+            import numpy
+            return numpy
+        except ImportError:
+            return None
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _encode(self, column: str, value) -> int:
+        if value is None:
+            return -1
+        category_codes = self._category_codes[column]
+        code = category_codes.get(value)
+        if code is None:
+            code = category_codes[value] = len(category_codes)
+            self.categories[column].append(value)
+        return code
+
+    def append(self, beacon: C2Beacon):
+        self.timestamps.append((beacon.timestamp - self.EPOCH).total_seconds())
+        self.codes['cookie_id'].append(
+            self._encode('cookie_id', str(beacon.cookie_id) if beacon.cookie_id else None)
+        )
+        self.codes['actor_ip'].append(self._encode('actor_ip', beacon.actor_ip))
+        self.codes['actor_asn_organization'].append(
+            self._encode('actor_asn_organization', beacon.actor_asn_organization)
+        )
+        self.codes['actor_country_code'].append(self._encode('actor_country_code', beacon.actor_country_code))
+        self.codes['c2'].append(self._encode('c2', beacon.c2))
+        self.codes['c2_asn_organization'].append(self._encode('c2_asn_organization', beacon.c2_asn_organization))
+        self.codes['c2_country_code'].append(self._encode('c2_country_code', beacon.c2_country_code))
+        self.codes['c2_domain'].append(self._encode('c2_domain', beacon.c2_domain))
+        self.codes['user_agent'].append(self._encode('user_agent', beacon.user_agent))
+        self.codes['tag'].append(self._encode('tag', beacon.tags[0].value if beacon.tags else None))
+
+    def extend(self, beacons: typing.Iterable[C2Beacon]):
+        for beacon in beacons:
+            self.append(beacon)
+
+    def column(self, column: str) -> typing.List:
+        categories = self.categories[column]
+        return [None if code < 0 else categories[code] for code in self.codes[column]]
+
+    def unique(self, column: str) -> typing.List:
+        """All values of the column in order of their first occurrence, without None."""
+        return list(self.categories[column])
+
+    def counts(self, column: str) -> typing.List[int]:
+        """Number of rows per category code of the column."""
+        numpy = self._numpy()
+        codes = self.codes[column]
+        if numpy is not None:
+            codes = numpy.frombuffer(codes, dtype=numpy.dtype(codes.typecode))
+            return numpy.bincount(codes[codes >= 0], minlength=len(self.categories[column])).tolist()
+        counts = [0] * len(self.categories[column])
+        for code, count in collections.Counter(codes).items():
+            if code >= 0:
+                counts[code] = count
+        return counts
+
+    def top(self, column: str, limit: int = None) -> typing.List:
+        """Values of the column ordered by how often they occur."""
+        return [value for value, _ in self.value_counts(column)[:limit]]
+
+    def value_counts(self, column: str) -> typing.List[typing.Tuple[typing.Any, int]]:
+        categories = self.categories[column]
+        return sorted(zip(categories, self.counts(column)), key=lambda item: -item[1])
+
+    def group_by(self, column: str) -> typing.Dict[typing.Any, typing.Tuple[int, datetime.datetime, datetime.datetime]]:
+        """Maps every value of the column to its number of rows, first and last timestamp."""
+        categories = self.categories[column]
+        numpy = self._numpy()
+        if numpy is not None:
+            codes = numpy.frombuffer(self.codes[column], dtype=numpy.dtype(self.codes[column].typecode))
+            timestamps = numpy.frombuffer(self.timestamps, dtype=numpy.float64)
+            mask = codes >= 0
+            codes, timestamps = codes[mask], timestamps[mask]
+            counts = numpy.bincount(codes, minlength=len(categories))
+            first = numpy.full(len(categories), numpy.inf)
+            numpy.minimum.at(first, codes, timestamps)
+            last = numpy.full(len(categories), -numpy.inf)
+            numpy.maximum.at(last, codes, timestamps)
+            groups = zip(counts.tolist(), first.tolist(), last.tolist())
+        else:
+            groups = [[0, float('inf'), float('-inf')] for _ in categories]
+            for code, timestamp in zip(self.codes[column], self.timestamps):
+                if code >= 0:
+                    group = groups[code]
+                    group[0] += 1
+                    if timestamp < group[1]:
+                        group[1] = timestamp
+                    if timestamp > group[2]:
+                        group[2] = timestamp
+        return {
+            value: (count, self._to_datetime(first), self._to_datetime(last))
+            for value, (count, first, last) in zip(categories, groups)
+        }
+
+    def _to_datetime(self, timestamp: float) -> datetime.datetime:
+        return self.EPOCH + datetime.timedelta(seconds=timestamp)
+
+    def min_timestamp(self) -> typing.Optional[datetime.datetime]:
+        if not self.timestamps:
+            return None
+        numpy = self._numpy()
+        return self._to_datetime(
+            numpy.frombuffer(self.timestamps, dtype=numpy.float64).min() if numpy else min(self.timestamps)
+        )
+
+    def max_timestamp(self) -> typing.Optional[datetime.datetime]:
+        if not self.timestamps:
+            return None
+        numpy = self._numpy()
+        return self._to_datetime(
+            numpy.frombuffer(self.timestamps, dtype=numpy.float64).max() if numpy else max(self.timestamps)
+        )
+
+    def hour_histogram(self) -> typing.Dict[int, int]:
+        """Number of rows per hour of the day, leaving out hours without any."""
+        numpy = self._numpy()
+        if numpy is not None:
+            hours = (numpy.frombuffer(self.timestamps, dtype=numpy.float64) // 3600 % 24).astype(numpy.int64)
+            counts = numpy.bincount(hours, minlength=24).tolist()
+        else:
+            counts = [0] * 24
+            for timestamp in self.timestamps:
+                counts[int(timestamp // 3600 % 24)] += 1
+        return {hour: count for hour, count in enumerate(counts) if count}
+
+
+class BeaconSession:
+    """Run of beacons with the same cookie ID, actor IP and C2 without a longer pause between them."""
+    __slots__ = ('cookie_id', 'actor_ip', 'c2', 'first_seen', 'last_seen', 'count', '_edge', '_seen')
+
+    def __init__(self, cookie_id: str, actor_ip: str, c2: str, timestamp: datetime.datetime):
+        self.cookie_id = cookie_id
+        self.actor_ip = actor_ip
+        self.c2 = c2
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.count = 0
+        # identities of the beacons at the timestamp last added, an ordered stream repeats a beacon only there
+        self._edge = timestamp
+        self._seen = set()
+
+    def to_dict(self) -> dict:
+        return {
+            'cookie_id': self.cookie_id,
+            'actor_ip': self.actor_ip,
+            'c2': self.c2,
+            'first_seen': DateTimeFactory.to_str(self.first_seen),
+            'last_seen': DateTimeFactory.to_str(self.last_seen),
+            'count': self.count,
+        }
+
+    def __repr__(self):
+        return F'BeaconSession({self.cookie_id!r}, {self.actor_ip!r}, {self.c2!r}, {self.first_seen} - ' \
+               F'{self.last_seen}, {self.count})'
+
+
+class TimelineSummarizer:
+    """
+    Groups a stream of beacons into sessions per cookie ID, actor IP and C2: a beacon continues the open session of
+    its key if it is at most `gap` seconds away from it and starts a new one otherwise. Repeated beacons are counted
+    once.
+
+    The beacons must be ordered by timestamp (ascending or descending), so a session further than `gap` away from the
+    current beacon cannot be continued anymore and is closed right away. Only the open sessions are kept, each beacon
+    is handled in constant time. A beacon out of order raises a `MalBeaconException` instead of splitting sessions.
+    """
+
+    def __init__(self, gap: float = 3600):
+        self.gap = datetime.timedelta(seconds=gap)
+        self.beacons = 0
+        self.duplicates = 0
+        self._previous = None
+        # 1 for ascending, -1 for descending timestamps, 0 until two different ones were seen
+        self._direction = 0
+        # open sessions by key, least recently continued first
+        self._open = collections.OrderedDict()
+
+    # the key and the timestamp are the same for all beacons compared, the locations follow from the other fields
+    _STRING_VALUES = operator.attrgetter(*(attribute for _, attribute in C2Beacon.STRING_FIELDS))
+
+    def _identity(self, beacon: C2Beacon) -> tuple:
+        return self._STRING_VALUES(beacon), tuple(tag.value for tag in beacon.tags or ())
+
+    def _distance(self, session: BeaconSession, timestamp: datetime.datetime) -> datetime.timedelta:
+        if timestamp > session.last_seen:
+            return timestamp - session.last_seen
+        if timestamp < session.first_seen:
+            return session.first_seen - timestamp
+        return datetime.timedelta(0)
+
+    def add(self, beacon: C2Beacon) -> typing.List[BeaconSession]:
+        """Adds a beacon and returns the sessions closed by it."""
+        timestamp = beacon.timestamp
+        if self._previous is not None and timestamp != self._previous:
+            direction = 1 if timestamp > self._previous else -1
+            if self._direction == 0:
+                self._direction = direction
+            elif direction != self._direction:
+                raise MalBeaconException(
+                    F'Beacons are not ordered by timestamp: {timestamp} follows {self._previous}, sort them first'
+                )
+        self._previous = timestamp
+        closed = []
+        while self._open:
+            session = next(iter(self._open.values()))
+            if self._distance(session, timestamp) <= self.gap:
+                break
+            closed.append(self._open.popitem(last=False)[1])
+
+        self.beacons += 1
+        key = (str(beacon.cookie_id) if beacon.cookie_id else None, beacon.actor_ip, beacon.c2)
+        session = self._open.get(key)
+        if session is None:
+            session = self._open[key] = BeaconSession(*key, timestamp)
+        elif self._distance(session, timestamp) > self.gap:
+            closed.append(session)
+            session = self._open[key] = BeaconSession(*key, timestamp)
+        self._open.move_to_end(key)
+
+        if timestamp != session._edge:
+            session._edge = timestamp
+            session._seen.clear()
+        identity = self._identity(beacon)
+        if identity in session._seen:
+            self.duplicates += 1
+            return closed
+        session._seen.add(identity)
+        session.count += 1
+        if timestamp < session.first_seen:
+            session.first_seen = timestamp
+        elif timestamp > session.last_seen:
+            session.last_seen = timestamp
+        return closed
+
+    def close(self) -> typing.List[BeaconSession]:
+        """Closes and returns all open sessions."""
+        closed = list(self._open.values())
+        self._open.clear()
+        return closed
+
+
+def summarize_timeline(beacons: typing.Iterable[C2Beacon], gap: float = 3600) -> typing.Iterator[BeaconSession]:
+    """Yields the sessions of `beacons` (see `TimelineSummarizer`) as soon as they are closed."""
+    summarizer = TimelineSummarizer(gap)
+    for beacon in beacons:
+        yield from summarizer.add(beacon)
+    yield from summarizer.close()
+
+
+class JsonArrayStream:
+    """
+    Incrementally decodes the elements of a top-level JSON array from an iterable of byte chunks, so the elements can
+    be processed while the rest of the body is still being received.
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    DELIMITERS = ', \t\n\r]'
+
+    def __init__(self, chunks: typing.Iterable[bytes]):
+        self.chunks = chunks
+
+    def __iter__(self) -> typing.Iterator:
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        chunks = iter(self.chunks)
+        buffer, position, finished = '', 0, False
+        state = 'start'
+
+        while True:
+            position = self.WHITESPACE.match(buffer, position).end()
+            element, end = None, None
+            if position < len(buffer):
+                char = buffer[position]
+                if state == 'start':
+                    if char != '[':
+                        raise MalBeaconParsingException(F'Expected JSON array, got: {buffer[position:position + 20]!r}')
+                    position, state = position + 1, 'element_or_end'
+                    continue
+                if char == ']' and state in ('element_or_end', 'separator_or_end'):
+                    return
+                if state == 'separator_or_end':
+                    if char != ',':
+                        raise MalBeaconParsingException(F'Unexpected character in JSON array: {char!r}')
+                    position, state = position + 1, 'element'
+                    continue
+                try:
+                    element, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    pass
+                # unlike strings and containers, numbers and literals are only complete if followed by a delimiter,
+                # they might continue in the next chunk otherwise (e.g. "4500" followed by ".0")
+                if end is not None and not finished and buffer[end - 1] not in '"]}' \
+                        and (end == len(buffer) or buffer[end] not in self.DELIMITERS):
+                    end = None
+                if end is not None:
+                    position, state = end, 'separator_or_end'
+                    yield element
+                    continue
+
+            if finished:
+                raise MalBeaconParsingException(F'Incomplete JSON array: {buffer[position:position + 20]!r}')
+            chunk = next(chunks, None)
+            finished = chunk is None
+            buffer, position = buffer[position:] + text_decoder.decode(chunk or b'', final=finished), 0
+
+
+# seconds to wait for other processes writing to the same database, e.g. the workers of a ShardedBulkRunner
+SQLITE_BUSY_TIMEOUT = 60
+
+
+def connect_sqlite(path: str, **kwargs):
+    """
+    Opens a database which may be shared by several threads and processes: in WAL mode, readers do not block the
+    writer and commits need not wait for the disk. Writers wait up to `SQLITE_BUSY_TIMEOUT` for each other.
+    """
+    import sqlite3
+
+    if path != ':memory:' and os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False, **kwargs)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of raw API responses, keyed on the request URL (base URL, endpoint and query value). Entries
+    expire after a per-endpoint TTL and the least recently used ones are evicted once `max_entries` is exceeded. In
+    `offline` mode expired entries are served anyway, with `refresh` cached entries are ignored but still updated.
+    """
+    DEFAULT_TTL = 24 * 60 * 60
+    DEFAULT_TTLS = {
+        'c2city': 60 * 60,
+        'c2country': 60 * 60,
+        'c2asnorg': 60 * 60,
+        'actorcity': 60 * 60,
+        'actorcountrycode': 60 * 60,
+        'actorasnorg': 60 * 60,
+        'useragent': 60 * 60,
+        'tags': 60 * 60,
+    }
+
+    def __init__(self, path: str, ttls: typing.Dict[str, float] = None, default_ttl: float = DEFAULT_TTL,
+                 max_entries: int = 10000, max_body_size: int = 16 * 1024 * 1024, refresh: bool = False,
+                 offline: bool = False):
+        self.ttls = dict(self.DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.max_body_size = max_body_size
+        self.refresh = refresh
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = connect_sqlite(path, isolation_level=None)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'path TEXT PRIMARY KEY, endpoint TEXT NOT NULL, body BLOB NOT NULL, fetched REAL NOT NULL, '
+            'accessed REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        # URLs look like "<base URL>/c2/<endpoint>/<value>", where the value may contain "/c2/" as well
+        return url.split('/c2/', 1)[1].split('/', 1)[0]
+
+    def ttl(self, url: str) -> float:
+        return self.ttls.get(self.endpoint(url), self.default_ttl)
+
+    def get(self, url: str) -> typing.Optional[bytes]:
+        if self.refresh:
+            self.misses += 1
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT body, fetched FROM responses WHERE path = ?', (url,)).fetchone()
+            if row is None or (not self.offline and row[1] + self.ttl(url) < now):
+                self.misses += 1
+                if self.offline:
+                    raise MalBeaconException(F'No cached response for "{url}" available in offline mode')
+                return None
+            self._connection.execute('UPDATE responses SET accessed = ? WHERE path = ?', (now, url))
+            self.hits += 1
+        return row[0]
+
+    def put(self, url: str, body: bytes):
+        now = time.time()
+        with self._lock:
+            # one transaction, which takes the write lock right away instead of on the first write
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO responses (path, endpoint, body, fetched, accessed) VALUES (?, ?, ?, ?, ?)',
+                    (url, self.endpoint(url), body, now, now)
+                )
+                self._connection.execute(
+                    'DELETE FROM responses WHERE path IN ('
+                    'SELECT path FROM responses ORDER BY accessed LIMIT MAX((SELECT COUNT(*) FROM responses) - ?, 0))',
+                    (self.max_entries,)
+                )
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` requests per second with bursts of up to `burst` requests. A single instance may be
+    shared by any number of threads and asyncio tasks; waiting callers reserve their token up front, so they are
+    served in order and the aggregate rate never exceeds the configured one.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def pause(self, seconds: float):
+        """Withholds tokens from all callers for the given time, e.g. after the API told us to back off."""
+        with self._lock:
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        import asyncio
+
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    `RateLimiter` keeping its bucket in shared memory, so all processes it is handed to (e.g. as argument of a pool's
+    initializer) draw from one common budget.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        import multiprocessing
+
+        self.rate = float(rate)
+        self.burst = burst
+        # tokens and time of the last update
+        self._state = multiprocessing.Array('d', [float(burst), time.monotonic()])
+
+    def _reserve(self) -> float:
+        with self._state.get_lock():
+            now = time.monotonic()
+            tokens = min(float(self.burst), self._state[0] + (now - self._state[1]) * self.rate) - 1
+            self._state[0], self._state[1] = tokens, now
+            return -tokens / self.rate if tokens < 0 else 0.0
+
+    def pause(self, seconds: float):
+        with self._state.get_lock():
+            self._state[0] = min(self._state[0], 0.0) - seconds * self.rate
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter for rate-limited (429), failing (5xx) and timed out requests."""
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, retries: int = 3, backoff: float = 0.5, max_backoff: float = 60.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def should_retry(self, attempt: int, status_code: int = None) -> bool:
+        return attempt < self.retries and (status_code is None or status_code in self.RETRY_STATUS_CODES)
+
+    def delay(self, attempt: int, retry_after: str = None) -> float:
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0.0), self.max_backoff)
+            except ValueError:
+                import email.utils
+                try:
+                    retry_at = email.utils.parsedate_to_datetime(retry_after)
+                    return min(max(retry_at.timestamp() - time.time(), 0.0), self.max_backoff)
+                except (TypeError, ValueError):
+                    pass
+        import random
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class Metrics:
+    """
+    Thread-safe registry of per-endpoint client metrics: requests, retries, errors, cache hits and misses, received
+    bytes and decoded records, as well as the time spent waiting for responses (latency until the headers arrived),
+    receiving bodies, parsing JSON and constructing `C2Beacon` objects. Subclasses may override `add` and `observe`
+    to forward measurements elsewhere.
+    """
+    COUNTERS = collections.OrderedDict([
+        ('requests', 'HTTP requests sent, including retries.'),
+        ('retries', 'Requests repeated after rate limiting, server errors or timeouts.'),
+        ('errors', 'Lookups failed with an API or connection error.'),
+        ('cache_hits', 'Lookups answered from the response cache.'),
+        ('cache_misses', 'Lookups not found in the response cache.'),
+        ('response_bytes', 'Bytes of response bodies received.'),
+        ('records', 'Beacons decoded.'),
+        ('transfer_seconds', 'Time spent receiving response bodies.'),
+        ('parse_seconds', 'Time spent parsing JSON.'),
+        ('decode_seconds', 'Time spent constructing beacons from parsed JSON.'),
+    ])
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    class Endpoint:
+        def __init__(self):
+            self.counters = dict.fromkeys(Metrics.COUNTERS, 0)
+            self.latency_buckets = [0] * (len(Metrics.LATENCY_BUCKETS) + 1)
+            self.latency_sum = 0.0
+            self.latency_max = 0.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = collections.defaultdict(self.Endpoint)
+
+    def add(self, endpoint: str, name: str, value: float = 1):
+        with self._lock:
+            self._endpoints[endpoint].counters[name] += value
+
+    def observe(self, endpoint: str, latency: float):
+        """Records the latency of a request, i.e. the time until its response headers were received."""
+        bucket = next(
+            (i for i, bound in enumerate(self.LATENCY_BUCKETS) if latency <= bound), len(self.LATENCY_BUCKETS)
+        )
+        with self._lock:
+            metrics = self._endpoints[endpoint]
+            metrics.latency_buckets[bucket] += 1
+            metrics.latency_sum += latency
+            metrics.latency_max = max(metrics.latency_max, latency)
+
+    def summary(self) -> typing.List[typing.List[str]]:
+        """Table rows (including a header) with one row per endpoint."""
+        rows = [[
+            'Endpoint', 'Requests', 'Retries', 'Errors', 'Cache hits', 'Latency avg/max', 'Received', 'Records',
+            'Transfer', 'Parse', 'Decode',
+        ]]
+        with self._lock:
+            for endpoint, metrics in sorted(self._endpoints.items()):
+                counters, latencies = metrics.counters, sum(metrics.latency_buckets)
+                rows.append([
+                    endpoint,
+                    str(counters['requests']),
+                    str(counters['retries']),
+                    str(counters['errors']),
+                    F'{counters["cache_hits"]}/{counters["cache_hits"] + counters["cache_misses"]}',
+                    F'{metrics.latency_sum / max(latencies, 1) * 1000:.0f}/{metrics.latency_max * 1000:.0f} ms',
+                    F'{counters["response_bytes"] / 1024:.1f} KiB',
+                    str(counters['records']),
+                    F'{counters["transfer_seconds"]:.3f} s',
+                    F'{counters["parse_seconds"]:.3f} s',
+                    F'{counters["decode_seconds"]:.3f} s',
+                ])
+        return rows
+
+    def to_prometheus(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            for name, description in self.COUNTERS.items():
+                metric = F'malbeacon_{name}_total'
+                lines.append(F'# HELP {metric} {description}')
+                lines.append(F'# TYPE {metric} counter')
+                for endpoint, metrics in endpoints:
+                    lines.append(F'{metric}{{endpoint="{endpoint}"}} {metrics.counters[name]}')
+
+            metric = 'malbeacon_request_latency_seconds'
+            lines.append(F'# HELP {metric} Time until the response headers were received.')
+            lines.append(F'# TYPE {metric} histogram')
+            for endpoint, metrics in endpoints:
+                count = 0
+                for bound, observations in zip(self.LATENCY_BUCKETS + ('+Inf',), metrics.latency_buckets):
+                    count += observations
+                    lines.append(F'{metric}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(F'{metric}_sum{{endpoint="{endpoint}"}} {metrics.latency_sum}')
+                lines.append(F'{metric}_count{{endpoint="{endpoint}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """Writes all metrics to `path` atomically, e.g. for the textfile collector of the node exporter."""
+        temporary_path = F'{path}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(temporary_path, path)
+
+
+class BulkResult:
+    def __init__(self, value, beacons: typing.List[C2Beacon] = None, exception: Exception = None):
+        self.value = value
+        self.beacons = beacons
+        self.exception = exception
+
+    @property
+    def ok(self):
+        return self.exception is None
+
+    def __repr__(self):
+        status = F'{len(self.beacons)} beacons' if self.ok else repr(self.exception)
+        return F'<{self.__class__.__name__} {self.value} {status}>'
+
+
+class BeaconStore:
+    """
+    SQLite database of fetched beacons, which are upserted by `MalBeaconClient` and indexed on the fields of all API
+    lookups. Offers the same `by_*` and `iter_by_*` methods as the client, answering them from the collected data.
+    """
+    BATCH_SIZE = 1000
+    COLUMNS = (
+        ('timestamp', 'tstamp'),
+        ('cookie_id', 'cookie_id'),
+        ('actor_ip', 'actorip'),
+        ('actor_hostname', 'actorhostname'),
+        ('actor_city', 'actorcity'),
+        ('actor_country_code', 'actorcountrycode'),
+        ('actor_asn_organization', 'actorasnorg'),
+        ('c2', 'c2'),
+        ('c2_ip', 'c2domainresolved'),
+        ('c2_domain', 'c2domain'),
+        ('c2_city', 'c2city'),
+        ('c2_country_code', 'c2countrycode'),
+        ('c2_asn_organization', 'c2asnorg'),
+        ('user_agent', 'useragent'),
+        ('tag', 'tags'),
+    )
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._connection = connect_sqlite(path)
+        columns = ', '.join(F'{column} TEXT' for column, _ in self.COLUMNS)
+        self._connection.execute(
+            F'CREATE TABLE IF NOT EXISTS beacons (fingerprint TEXT PRIMARY KEY, {columns}, actor_asn INTEGER, '
+            F'c2_asn INTEGER, line TEXT NOT NULL)'
+        )
+        for column in [column for column, _ in self.COLUMNS] + ['actor_asn', 'c2_asn']:
+            self._connection.execute(F'CREATE INDEX IF NOT EXISTS beacons_{column} ON beacons ({column})')
+        self._connection.commit()
+
+    @staticmethod
+    def fingerprint(line: dict) -> str:
+        import hashlib
+
+        return hashlib.sha1(json.dumps(line, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _row(self, line: dict) -> tuple:
+        def value(key):
+            return None if MalBeaconClient.is_null(line.get(key)) else line[key]
+
+        actor_asn_organization, c2_asn_organization = value('actorasnorg'), value('c2asnorg')
+        return (self.fingerprint(line),) + tuple(value(key) for _, key in self.COLUMNS) + (
+            Guesser.guess_numeric_asn_from_organization_string(actor_asn_organization)
+            if actor_asn_organization else None,
+            Guesser.guess_numeric_asn_from_organization_string(c2_asn_organization) if c2_asn_organization else None,
+            json.dumps(line),
+        )
+
+    def upsert(self, lines: typing.Iterable[dict]) -> int:
+        """Inserts or replaces the given response lines, returns how many there were."""
+        rows = [self._row(line) for line in lines]
+        placeholders = ', '.join('?' for _ in range(len(self.COLUMNS) + 4))
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(F'INSERT OR REPLACE INTO beacons VALUES ({placeholders})', rows)
+        return len(rows)
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM beacons').fetchone()[0]
+
+    def _select(self, where: str, *parameters, **query) -> typing.Iterator[C2Beacon]:
+        decode = C2Beacon.from_response_line
+        if query:
+            query = BeaconQuery(**query)
+            decode = query.decode
+            # the timestamp column holds the raw response timestamps, which the bounds compare to as strings
+            if query.since is not None:
+                where, parameters = F'{where} AND timestamp >= ?', parameters + (query.since,)
+            if query.until is not None:
+                where, parameters = F'{where} AND timestamp < ?', parameters + (query.until,)
+        with self._lock:
+            cursor = self._connection.execute(
+                F'SELECT line FROM beacons WHERE {where} ORDER BY timestamp', parameters
+            )
+            rows = cursor.fetchmany(self.BATCH_SIZE)
+        while rows:
+            for row in rows:
+                beacon = decode(json.loads(row[0]))
+                if beacon is not None:
+                    yield beacon
+            with self._lock:
+                rows = cursor.fetchmany(self.BATCH_SIZE)
+
+    def _lookup(self, kind: str, value, **query) -> typing.Iterator[C2Beacon]:
+        column = MalBeaconClient.LOOKUP_COLUMNS[kind]
+        return self._select(F'{column} = ?', value if isinstance(value, int) else str(value), **query)
+
+    def iter_by_cookie_id(self, cookie_id: CookieId, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('cookie', cookie_id, **query)
+
+    def iter_by_c2_ip(self, ip: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('c2ip', ip, **query)
+
+    def iter_by_c2(self, c2: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('c2', c2, **query)
+
+    def iter_by_c2_city(self, city: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('c2city', city, **query)
+
+    def iter_by_c2_country(self, country: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('c2country', country, **query)
+
+    def iter_by_c2_asn(self, asn: int, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('c2asn', asn, **query)
+
+    def iter_by_actor_ip(self, ip: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('actorip', ip, **query)
+
+    def iter_by_actor_hostname(self, hostname: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('actorhostname', hostname, **query)
+
+    def iter_by_actor_city(self, city: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('actorcity', city, **query)
+
+    def iter_by_actor_country(self, country: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('actorcountry', country, **query)
+
+    def iter_by_actor_asn(self, asn: int, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('actorasn', asn, **query)
+
+    def iter_by_user_agent(self, user_agent: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('useragent', user_agent, **query)
+
+    def iter_by_tag(self, tag: Tag, **query) -> typing.Iterator[C2Beacon]:
+        return self._lookup('tag', tag, **query)
+
+    def by_cookie_id(self, cookie_id: CookieId, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_cookie_id(cookie_id, **query))
+
+    def by_c2_ip(self, ip: str, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_c2_ip(ip, **query))
+
+    def by_c2(self, c2: str, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_c2(c2, **query))
+
+    def by_c2_city(self, city: str, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_c2_city(city, **query))
+
+    def by_c2_country(self, country: str, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_c2_country(country, **query))
+
+    def by_c2_asn(self, asn: int, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_c2_asn(asn, **query))
+
+    def by_actor_ip(self, ip: str, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_actor_ip(ip, **query))
+
+    def by_actor_hostname(self, hostname: str, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_actor_hostname(hostname, **query))
+
+    def by_actor_city(self, city: str, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_actor_city(city, **query))
+
+    def by_actor_country(self, country: str, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_actor_country(country, **query))
+
+    def by_actor_asn(self, asn: int, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_actor_asn(asn, **query))
+
+    def by_user_agent(self, user_agent: str, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_user_agent(user_agent, **query))
+
+    def by_tag(self, tag: Tag, **query) -> typing.List[C2Beacon]:
+        return list(self.iter_by_tag(tag, **query))
+
+    def lookup(self, kind: str, value, **query) -> typing.List[C2Beacon]:
+        if kind not in MalBeaconClient.LOOKUPS:
+            raise MalBeaconException(F'Unknown lookup kind: {kind}')
+        return getattr(self, MalBeaconClient.LOOKUPS[kind])(value, **query)
+
+    def lookup_many(self, kind: str, values: typing.Iterable, workers: int = None,
+                    **query) -> typing.Iterator[BulkResult]:
+        # local lookups are index lookups, so there is nothing to gain from running them concurrently
+        for value in values:
+            try:
+                yield BulkResult(value, self.lookup(kind, value, **query))
+            except Exception as e:
+                yield BulkResult(value, exception=e)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: while one call is running, everybody else asking for the same key
+    waits for it and receives its result instead of starting another one. Results can additionally be remembered
+    for `memo_ttl` seconds to absorb bursts of repeated calls.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exception = None
+
+    def __init__(self, memo_ttl: float = 0):
+        self.memo_ttl = memo_ttl
+        self.coalesced = 0
+        self.memo_hits = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        # results in order of expiry, as all of them are kept for the same time
+        self._memo = collections.OrderedDict()
+
+    def _remembered(self, key):
+        now = time.monotonic()
+        while self._memo and next(iter(self._memo.values()))[0] <= now:
+            self._memo.popitem(last=False)
+        if key in self._memo:
+            self.memo_hits += 1
+            return True, self._memo[key][1]
+        return False, None
+
+    def _remember(self, key, result):
+        if self.memo_ttl > 0:
+            self._memo.pop(key, None)
+            self._memo[key] = (time.monotonic() + self.memo_ttl, result)
+
+    @staticmethod
+    def aborted(exception: BaseException) -> MalBeaconException:
+        """Exception raised to callers waiting for a call that was interrupted or cancelled."""
+        return MalBeaconException(F'The call this one was coalesced with was aborted: {exception!r}')
+
+    def do(self, key, function: typing.Callable):
+        with self._lock:
+            remembered, result = self._remembered(key)
+            if remembered:
+                return result
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = function()
+            except Exception as e:
+                call.exception = e
+            except BaseException as e:
+                call.exception = self.aborted(e)
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                    if call.exception is None:
+                        self._remember(key, call.result)
+                call.done.set()
+
+        if call.exception is not None:
+            raise call.exception
+        return call.result
+
+    async def do_async(self, key, function: typing.Callable):
+        """Same as `do` for coroutine functions; calls are coalesced within the running event loop."""
+        import asyncio
+
+        with self._lock:
+            remembered, result = self._remembered(key)
+        if remembered:
+            return result
+        future = self._async_calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function()
+        except BaseException as e:
+            # a cancelled leader must not cancel the callers waiting for it, but must not leave them hanging either
+            if isinstance(e, Exception) and not isinstance(e, asyncio.CancelledError):
+                future.set_exception(e)
+            else:
+                future.set_exception(self.aborted(e))
+            # mark the exception as retrieved, in case nobody else was waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            with self._lock:
+                self._remember(key, result)
+            return result
+        finally:
+            del self._async_calls[key]
+
+
+class HttpxTransport:
+    """
+    Transport for `MalBeaconClient` backed by `httpx`, which multiplexes all requests over few HTTP/2 connections.
+    Network errors are translated into their `requests` counterparts, so the client's retry handling applies as is.
+    """
+
+    class Response:
+        def __init__(self, response):
+            self.response = response
+
+        @property
+        def status_code(self):
+            return self.response.status_code
+
+        @property
+        def headers(self):
+            return self.response.headers
+
+        @property
+        def content(self):
+            return self.response.read()
+
+        def json(self):
+            return json.loads(self.content)
+
+        def iter_content(self, chunk_size):
+            return self.response.iter_bytes(chunk_size)
+
+        def close(self):
+            self.response.close()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self.close()
+
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 5, read_timeout: float = 5, http2: bool = True):
+        try:
+            import httpx
+        except ImportError:
+            raise MalBeaconException('HttpxTransport requires the package "httpx[http2]" to be installed')
+        self.httpx = httpx
+        self.headers = {}
+        self.client = httpx.Client(
+            http2=http2,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+
+    def get(self, url, stream: bool = False):
+        import requests.exceptions
+
+        try:
+            response = self.client.send(self.client.build_request('GET', url, headers=self.headers), stream=stream)
+        except self.httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e)
+        except self.httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e)
+        return self.Response(response)
+
+    def close(self):
+        self.client.close()
+
+
 class MalBeaconClient:
-    def __init__(self, api_key: str, user_agent: str, base_url: str):
+    """
+    Client of the MalBeacon API. One instance is meant to be shared by all threads of a process: the session is created
+    on the first request and not modified afterwards, its connection pool (`pool_size` connections per host, kept
+    alive between requests) as well as the cache, store and rate limiter are all thread-safe. Instead of the default
+    `requests` session (with a default `user_agent` mentioning the versions of the client and `requests`), any
+    `transport` with a compatible `get(url, stream)` method can be used, e.g. `HttpxTransport` for HTTP/2. Pass
+    `metrics` to record per-endpoint timings and counters of all lookups. All lookup methods accept the keyword
+    arguments of `BeaconQuery` to decode only some fields of the beacons and filter them while decoding.
+    """
+    # lookup kind (and CLI command), method, API endpoint, `BeaconStore` column, name and description of its argument
+    ENDPOINTS = (
+        ('cookie', 'by_cookie_id', 'cookie_id', 'cookie_id', 'cookie_id', 'cookie ID'),
+        ('c2ip', 'by_c2_ip', 'c2ip', 'c2_ip', 'ip', 'C2 IP'),
+        ('c2', 'by_c2', 'c2', 'c2', 'c2', 'C2 URL'),
+        ('c2city', 'by_c2_city', 'c2city', 'c2_city', 'city', 'C2 city'),
+        ('c2country', 'by_c2_country', 'c2country', 'c2_country_code', 'country', 'C2 country code'),
+        ('c2asn', 'by_c2_asn', 'c2asnorg', 'c2_asn', 'asn', 'C2 ASN (number or organization)'),
+        ('actorip', 'by_actor_ip', 'actorip', 'actor_ip', 'ip', 'actor IP'),
+        ('actorhostname', 'by_actor_hostname', 'actorhostname', 'actor_hostname', 'hostname', 'actor hostname'),
+        ('actorcity', 'by_actor_city', 'actorcity', 'actor_city', 'city', 'actor city'),
+        ('actorcountry', 'by_actor_country', 'actorcountrycode', 'actor_country_code', 'country', 'actor country code'),
+        ('actorasn', 'by_actor_asn', 'actorasnorg', 'actor_asn', 'asn', 'actor ASN (number or organization)'),
+        ('useragent', 'by_user_agent', 'useragent', 'user_agent', 'user_agent', 'user agent'),
+        ('tag', 'by_tag', 'tags', 'tag', 'tag', 'tag'),
+    )
+    LOOKUPS = {kind: method for kind, method, _, _, _, _ in ENDPOINTS}
+    LOOKUP_ENDPOINTS = {kind: endpoint for kind, _, endpoint, _, _, _ in ENDPOINTS}
+    LOOKUP_COLUMNS = {kind: column for kind, _, _, column, _, _ in ENDPOINTS}
+    LOOKUP_ARGUMENTS = {kind: argument for kind, _, _, _, argument, _ in ENDPOINTS}
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, api_key: str, user_agent: str = None, base_url: str = 'https://api.malbeacon.com/v1',
+                 cache: ResponseCache = None,
+                 rate_limiter: RateLimiter = None, retry_policy: RetryPolicy = None, store: BeaconStore = None,
+                 pool_size: int = 10, connect_timeout: float = 5, read_timeout: float = 5, transport=None,
+                 single_flight: SingleFlight = None, metrics: Metrics = None):
         self.base_url = base_url
-
-        self.session = requests.session()
-        self.session.mount('https://', FixedTimeoutAdapter())
-        self.session.mount('http://', FixedTimeoutAdapter())
-        self.session.headers = {
+        self.cache = cache
+        self.metrics = metrics
+        self.single_flight = single_flight or SingleFlight()
+        self.store = store
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.headers = {
             'X-Api-Key': api_key,
             'User-Agent': user_agent,
         }
+        self._session = transport
+        self._session_lock = threading.Lock()
+        if transport is not None:
+            if user_agent is None:
+                self.headers['User-Agent'] = self.default_user_agent()
+            transport.headers = self.headers
+
+    @staticmethod
+    def default_user_agent() -> str:
+        import platform
+        import requests
+
+        return F'MalBeaconClient/{__version__} (python-requests {requests.__version__}) ' \
+               F'{platform.system()} ({platform.release()})'
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+
+                    session = requests.session()
+                    for prefix in ['https://', 'http://']:
+                        # retries are handled by our RetryPolicy, not by urllib3
+                        session.mount(prefix, _fixed_timeout_adapter()(
+                            timeout=(self.connect_timeout, self.read_timeout), pool_connections=self.pool_size,
+                            pool_maxsize=self.pool_size, max_retries=0,
+                        ))
+                    if self.headers['User-Agent'] is None:
+                        self.headers['User-Agent'] = self.default_user_agent()
+                    session.headers = self.headers
+                    self._session = session
+        return self._session
 
     @staticmethod
     def is_null(value):
         return value == 'NA' or value is None
 
-    def _get(self, url):
-        response = self.session.get(url)
-        if response.status_code == 400:
-            if response.json()['message'] == 'ERROR: No Results':
-                return []
-            raise MalBeaconApiException(F'Generic API Exception: {response.content}', url)
-        if response.status_code == 401:
-            if response.json()['message'] == 'ERROR: Unauthorized':
+    @staticmethod
+    def _check_response(status_code: int, content: bytes, url: str) -> bool:
+        """Raises the matching exception for an error response, returns False if there simply are no results."""
+        if status_code == 400:
+            if json.loads(content)['message'] == 'ERROR: No Results':
+                return False
+            raise MalBeaconApiException(F'Generic API Exception: {content}', url)
+        if status_code == 401:
+            if json.loads(content)['message'] == 'ERROR: Unauthorized':
                 raise MalBeaconUnauthorizedException(url)
-            raise MalBeaconApiException(F'Generic API Exception: {response.content}', url)
-        if response.status_code != 200:
-            raise MalBeaconApiException(F'Generic API Exception: {response.content}', url)
-
-        return response.json()
-
-    def by_cookie_id(self, cookie_id: CookieId) -> typing.List[C2Beacon]:
-        return [C2Beacon.from_response_line(line) for line in self._get(self.base_url + F'/c2/cookie_id/{cookie_id}')]
+            raise MalBeaconApiException(F'Generic API Exception: {content}', url)
+        if status_code == 429:
+            raise MalBeaconRequestExceedQuotaException(url)
+        if status_code != 200:
+            raise MalBeaconApiException(F'Generic API Exception: {content}', url)
+        return True
+
+    def _request(self, url, endpoint: str, stream: bool = False):
+        import requests.exceptions
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            if self.metrics is not None:
+                self.metrics.add(endpoint, 'requests')
+                if attempt:
+                    self.metrics.add(endpoint, 'retries')
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, stream=stream)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                if not self.retry_policy.should_retry(attempt):
+                    raise MalBeaconApiException(F'Connection failed: {e}', url)
+                time.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+                continue
+            if self.metrics is not None:
+                self.metrics.observe(endpoint, time.perf_counter() - start)
+            if not self.retry_policy.should_retry(attempt, response.status_code):
+                return response
+            delay = self.retry_policy.delay(attempt, response.headers.get('Retry-After'))
+            if response.status_code == 429 and self.rate_limiter is not None:
+                self.rate_limiter.pause(delay)
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def _loads(self, endpoint: str, content: bytes) -> typing.List[dict]:
+        if self.metrics is None:
+            return json.loads(content)
+        start = time.perf_counter()
+        lines = json.loads(content)
+        self.metrics.add(endpoint, 'parse_seconds', time.perf_counter() - start)
+        return lines
+
+    def _stream(self, endpoint: str, chunks: typing.Iterable[bytes]) -> typing.Iterator[dict]:
+        if self.metrics is None:
+            yield from JsonArrayStream(chunks)
+            return
+
+        # waiting for chunks happens while parsing, so it is measured separately and subtracted
+        received, transfer, parse = 0, 0.0, 0.0
+
+        def receive():
+            nonlocal received, transfer
+            chunk_iterator = iter(chunks)
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunk_iterator, None)
+                transfer += time.perf_counter() - start
+                if chunk is None:
+                    return
+                received += len(chunk)
+                yield chunk
+
+        elements = iter(JsonArrayStream(receive()))
+        try:
+            while True:
+                start, transfer_before = time.perf_counter(), transfer
+                try:
+                    element = next(elements)
+                finally:
+                    parse += time.perf_counter() - start - (transfer - transfer_before)
+                yield element
+        except StopIteration:
+            pass
+        finally:
+            self.metrics.add(endpoint, 'response_bytes', received)
+            self.metrics.add(endpoint, 'transfer_seconds', transfer)
+            self.metrics.add(endpoint, 'parse_seconds', parse)
+
+    def _iter(self, url) -> typing.Iterator[dict]:
+        endpoint = ResponseCache.endpoint(url)
+        # keyed on the whole URL, so responses of another server (e.g. a mock) are never mixed up with the API's
+        content = None if self.cache is None else self.cache.get(url)
+        if self.metrics is not None and self.cache is not None:
+            self.metrics.add(endpoint, 'cache_misses' if content is None else 'cache_hits')
+        if content is not None:
+            yield from self._loads(endpoint, content)
+            return
+
+        try:
+            response = self._request(url, endpoint, stream=True)
+        except MalBeaconApiException:
+            if self.metrics is not None:
+                self.metrics.add(endpoint, 'errors')
+            raise
+        with response:
+            if response.status_code != 200 or 'Content-Length' in response.headers \
+                    and int(response.headers['Content-Length']) <= self.STREAM_CHUNK_SIZE:
+                start = time.perf_counter()
+                content = response.content
+                if self.metrics is not None:
+                    self.metrics.add(endpoint, 'transfer_seconds', time.perf_counter() - start)
+                    self.metrics.add(endpoint, 'response_bytes', len(content))
+                try:
+                    if not self._check_response(response.status_code, content, url):
+                        content = b'[]'
+                except MalBeaconApiException:
+                    if self.metrics is not None:
+                        self.metrics.add(endpoint, 'errors')
+                    raise
+                if self.cache is not None:
+                    self.cache.put(url, content)
+                yield from self._loads(endpoint, content)
+                return
+
+            chunks = response.iter_content(self.STREAM_CHUNK_SIZE)
+            if self.cache is None:
+                yield from self._stream(endpoint, chunks)
+                return
+
+            # keep a copy of the body for the cache unless it turns out to be too large to keep in memory
+            recorded, recorded_size = [], 0
+
+            def record():
+                nonlocal recorded, recorded_size
+                for chunk in chunks:
+                    if recorded is not None:
+                        recorded.append(chunk)
+                        recorded_size += len(chunk)
+                        if recorded_size > self.cache.max_body_size:
+                            recorded = None
+                    yield chunk
+
+            yield from self._stream(endpoint, record())
+            if recorded is not None:
+                self.cache.put(url, b''.join(recorded))
 
-    def by_c2_ip(self, ip: str) -> typing.List[C2Beacon]:
-        return [C2Beacon.from_response_line(line) for line in self._get(self.base_url + F'/c2/c2ip/{ip}')]
-
-    def by_c2(self, c2: str) -> typing.List[C2Beacon]:
-        return [C2Beacon.from_response_line(line) for line in self._get(self.base_url + F'/c2/c2/{url_quote(c2)}')]
+    def _get(self, url):
+        return list(self._iter(url))
+
+    @classmethod
+    def lookup_path(cls, kind: str, value) -> str:
+        """Returns the API path of a lookup of the given kind, relative to the base URL."""
+        return F'/c2/{cls.LOOKUP_ENDPOINTS[kind]}/{url_quote(str(value))}'
+
+    def _stored(self, lines: typing.Iterable[dict]) -> typing.Iterator[dict]:
+        batch = []
+        try:
+            for line in lines:
+                batch.append(line)
+                if len(batch) >= self.store.BATCH_SIZE:
+                    self.store.upsert(batch)
+                    batch = []
+                yield line
+        finally:
+            self.store.upsert(batch)
 
-    def by_c2_city(self, city: str) -> typing.List[C2Beacon]:
-        return [C2Beacon.from_response_line(line) for line in self._get(self.base_url + F'/c2/c2city/{city}')]
+    def _beacons(self, path: str, **query) -> typing.Iterator[C2Beacon]:
+        lines = self._iter(self.base_url + path)
+        if self.store is not None:
+            lines = self._stored(lines)
+        decode = BeaconQuery(**query).decode if query else C2Beacon.from_response_line
+        if self.metrics is None:
+            for line in lines:
+                beacon = decode(line)
+                if beacon is not None:
+                    yield beacon
+            return
 
-    def by_c2_country(self, country: str) -> typing.List[C2Beacon]:
-        return [C2Beacon.from_response_line(line) for line in self._get(self.base_url + F'/c2/c2country/{country}')]
+        records, decode_seconds = 0, 0.0
+        try:
+            for line in lines:
+                start = time.perf_counter()
+                beacon = decode(line)
+                decode_seconds += time.perf_counter() - start
+                if beacon is not None:
+                    records += 1
+                    yield beacon
+        finally:
+            endpoint = ResponseCache.endpoint(path)
+            self.metrics.add(endpoint, 'records', records)
+            self.metrics.add(endpoint, 'decode_seconds', decode_seconds)
+
+    def _list(self, path: str, **query) -> typing.List[C2Beacon]:
+        # concurrent lookups of the same path and query share one request and its decoded beacons
+        key = (path, BeaconQuery(**query).key) if query else path
+        return list(self.single_flight.do(key, lambda: list(self._beacons(path, **query))))
+
+    def iter_by_cookie_id(self, cookie_id: CookieId, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('cookie', cookie_id), **query)
+
+    def iter_by_c2_ip(self, ip: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('c2ip', ip), **query)
+
+    def iter_by_c2(self, c2: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('c2', c2), **query)
+
+    def iter_by_c2_city(self, city: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('c2city', city), **query)
+
+    def iter_by_c2_country(self, country: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('c2country', country), **query)
+
+    def iter_by_c2_asn(self, asn: int, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('c2asn', asn), **query)
+
+    def iter_by_actor_ip(self, ip: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('actorip', ip), **query)
+
+    def iter_by_actor_hostname(self, hostname: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('actorhostname', hostname), **query)
+
+    def iter_by_actor_city(self, city: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('actorcity', city), **query)
+
+    def iter_by_actor_country(self, country: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('actorcountry', country), **query)
+
+    def iter_by_actor_asn(self, asn: int, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('actorasn', asn), **query)
+
+    def iter_by_user_agent(self, user_agent: str, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('useragent', user_agent), **query)
+
+    def iter_by_tag(self, tag: Tag, **query) -> typing.Iterator[C2Beacon]:
+        return self._beacons(self.lookup_path('tag', tag), **query)
+
+    def by_cookie_id(self, cookie_id: CookieId, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('cookie', cookie_id), **query)
+
+    def by_c2_ip(self, ip: str, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('c2ip', ip), **query)
+
+    def by_c2(self, c2: str, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('c2', c2), **query)
+
+    def by_c2_city(self, city: str, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('c2city', city), **query)
+
+    def by_c2_country(self, country: str, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('c2country', country), **query)
+
+    def by_c2_asn(self, asn: int, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('c2asn', asn), **query)
+
+    def by_actor_ip(self, ip: str, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('actorip', ip), **query)
+
+    def by_actor_hostname(self, hostname: str, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('actorhostname', hostname), **query)
+
+    def by_actor_city(self, city: str, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('actorcity', city), **query)
+
+    def by_actor_country(self, country: str, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('actorcountry', country), **query)
+
+    def by_actor_asn(self, asn: int, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('actorasn', asn), **query)
+
+    def by_user_agent(self, user_agent: str, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('useragent', user_agent), **query)
+
+    def by_tag(self, tag: Tag, **query) -> typing.List[C2Beacon]:
+        return self._list(self.lookup_path('tag', tag), **query)
+
+    def lookup(self, kind: str, value, **query) -> typing.List[C2Beacon]:
+        if kind not in self.LOOKUPS:
+            raise MalBeaconException(F'Unknown lookup kind: {kind}')
+        return getattr(self, self.LOOKUPS[kind])(value, **query)
+
+    def lookup_many(self, kind: str, values: typing.Iterable, workers: int = 8,
+                    **query) -> typing.Iterator[BulkResult]:
+        """
+        Looks up all values concurrently on a pool of at most `workers` threads and yields one `BulkResult` per value
+        in order of completion. Values are consumed lazily, so `values` may be an unbounded stream (e.g. stdin). A
+        failing lookup is reported on its result instead of aborting the remaining ones.
+        """
+        if kind not in self.LOOKUPS:
+            raise MalBeaconException(F'Unknown lookup kind: {kind}')
 
-    def by_c2_asn(self, asn: int) -> typing.List[C2Beacon]:
-        return [
-            C2Beacon.from_response_line(line) for line in
-            self._get(self.base_url + F'/c2/c2asnorg/{asn}')
-        ]
+        def work(value):
+            try:
+                return BulkResult(value, self.lookup(kind, value, **query))
+            except Exception as e:
+                return BulkResult(value, exception=e)
 
-    def by_actor_ip(self, ip: str) -> typing.List[C2Beacon]:
-        return [C2Beacon.from_response_line(line) for line in self._get(self.base_url + F'/c2/actorip/{ip}')]
+        import concurrent.futures
 
-    def by_actor_hostname(self, hostname: str) -> typing.List[C2Beacon]:
-        return [
-            C2Beacon.from_response_line(line)
-            for line in self._get(self.base_url + F'/c2/actorhostname/{hostname}')
-        ]
+        values = iter(values)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for value in values:
+                pending.add(executor.submit(work, value))
+                if len(pending) >= 2 * workers:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in concurrent.futures.as_completed(pending):
+                yield future.result()
 
-    def by_actor_city(self, city: str) -> typing.List[C2Beacon]:
-        return [C2Beacon.from_response_line(line) for line in self._get(self.base_url + F'/c2/actorcity/{city}')]
 
-    def by_actor_country(self, country: str) -> typing.List[C2Beacon]:
-        return [
-            C2Beacon.from_response_line(line)
-            for line in self._get(self.base_url + F'/c2/actorcountrycode/{country}')
-        ]
+class AsyncMalBeaconClient:
+    """
+    asyncio counterpart of `MalBeaconClient` backed by a pooled `aiohttp` session. All lookups share one connection
+    pool, so thousands of lookups can be in flight without a thread each. Use as `async with` or call `close()`.
+    """
 
-    def by_actor_asn(self, asn: int) -> typing.List[C2Beacon]:
-        return [
-            C2Beacon.from_response_line(line)
-            for line in self._get(self.base_url + F'/c2/actorasnorg/{asn}')
-        ]
+    def __init__(self, api_key: str, user_agent: str = None, base_url: str = 'https://api.malbeacon.com/v1',
+                 max_connections: int = 100, timeout: float = 5, cache: ResponseCache = None,
+                 rate_limiter: RateLimiter = None, retry_policy: RetryPolicy = None, single_flight: SingleFlight = None,
+                 metrics: Metrics = None):
+        try:
+            import aiohttp
+        except ImportError:
+            raise MalBeaconException('AsyncMalBeaconClient requires the package "aiohttp" to be installed')
+        self._aiohttp = aiohttp
+        self.base_url = base_url
+        self.cache = cache
+        self.metrics = metrics
+        self.single_flight = single_flight or SingleFlight()
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.headers = {
+            'X-Api-Key': api_key,
+            'User-Agent': user_agent,
+        }
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            if self.headers['User-Agent'] is None:
+                self.headers['User-Agent'] = MalBeaconClient.default_user_agent()
+            self._session = self._aiohttp.ClientSession(
+                headers=self.headers,
+                connector=self._aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=self._aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _get(self, url):
+        endpoint = ResponseCache.endpoint(url)
+        content = None if self.cache is None else self.cache.get(url)
+        if self.metrics is not None and self.cache is not None:
+            self.metrics.add(endpoint, 'cache_misses' if content is None else 'cache_hits')
+        if content is not None:
+            return self._loads(endpoint, content)
+
+        import asyncio
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async()
+            if self.metrics is not None:
+                self.metrics.add(endpoint, 'requests')
+                if attempt:
+                    self.metrics.add(endpoint, 'retries')
+            start = time.perf_counter()
+            try:
+                async with self.session.get(url) as response:
+                    received = time.perf_counter()
+                    status, retry_after, content = response.status, response.headers.get('Retry-After'), \
+                        await response.read()
+            except (asyncio.TimeoutError, self._aiohttp.ClientConnectionError) as e:
+                if not self.retry_policy.should_retry(attempt):
+                    if self.metrics is not None:
+                        self.metrics.add(endpoint, 'errors')
+                    raise MalBeaconApiException(F'Connection failed: {e!r}', url)
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+                continue
+            if self.metrics is not None:
+                self.metrics.observe(endpoint, received - start)
+                self.metrics.add(endpoint, 'transfer_seconds', time.perf_counter() - received)
+                self.metrics.add(endpoint, 'response_bytes', len(content))
+            if not self.retry_policy.should_retry(attempt, status):
+                break
+            delay = self.retry_policy.delay(attempt, retry_after)
+            if status == 429 and self.rate_limiter is not None:
+                self.rate_limiter.pause(delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        try:
+            if not MalBeaconClient._check_response(status, content, url):
+                content = b'[]'
+        except MalBeaconApiException:
+            if self.metrics is not None:
+                self.metrics.add(endpoint, 'errors')
+            raise
+        if self.cache is not None:
+            self.cache.put(url, content)
+
+        return self._loads(endpoint, content)
+
+    _loads = MalBeaconClient._loads
+
+    async def _beacons(self, path: str, **query) -> typing.List[C2Beacon]:
+        query = BeaconQuery(**query) if query else None
+
+        async def fetch():
+            lines = await self._get(self.base_url + path)
+            start = time.perf_counter()
+            if query is None:
+                beacons = [C2Beacon.from_response_line(line) for line in lines]
+            else:
+                beacons = [beacon for beacon in map(query.decode, lines) if beacon is not None]
+            if self.metrics is not None:
+                endpoint = ResponseCache.endpoint(path)
+                self.metrics.add(endpoint, 'records', len(beacons))
+                self.metrics.add(endpoint, 'decode_seconds', time.perf_counter() - start)
+            return beacons
+
+        return list(await self.single_flight.do_async(path if query is None else (path, query.key), fetch))
+
+    async def by_cookie_id(self, cookie_id: CookieId, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('cookie', cookie_id), **query)
+
+    async def by_c2_ip(self, ip: str, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('c2ip', ip), **query)
+
+    async def by_c2(self, c2: str, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('c2', c2), **query)
+
+    async def by_c2_city(self, city: str, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('c2city', city), **query)
+
+    async def by_c2_country(self, country: str, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('c2country', country), **query)
+
+    async def by_c2_asn(self, asn: int, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('c2asn', asn), **query)
+
+    async def by_actor_ip(self, ip: str, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('actorip', ip), **query)
+
+    async def by_actor_hostname(self, hostname: str, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('actorhostname', hostname), **query)
+
+    async def by_actor_city(self, city: str, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('actorcity', city), **query)
+
+    async def by_actor_country(self, country: str, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('actorcountry', country), **query)
+
+    async def by_actor_asn(self, asn: int, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('actorasn', asn), **query)
+
+    async def by_user_agent(self, user_agent: str, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('useragent', user_agent), **query)
+
+    async def by_tag(self, tag: Tag, **query) -> typing.List[C2Beacon]:
+        return await self._beacons(MalBeaconClient.lookup_path('tag', tag), **query)
+
+    async def lookup(self, kind: str, value, **query) -> typing.List[C2Beacon]:
+        if kind not in MalBeaconClient.LOOKUPS:
+            raise MalBeaconException(F'Unknown lookup kind: {kind}')
+        return await getattr(self, MalBeaconClient.LOOKUPS[kind])(value, **query)
+
+    async def lookup_many(self, kind: str, values: typing.Iterable, concurrency: int = 100, **query):
+        """Async generator counterpart of `MalBeaconClient.lookup_many` with at most `concurrency` lookups in flight."""
+        import asyncio
+
+        if kind not in MalBeaconClient.LOOKUPS:
+            raise MalBeaconException(F'Unknown lookup kind: {kind}')
+
+        async def work(value):
+            try:
+                return BulkResult(value, await self.lookup(kind, value, **query))
+            except Exception as e:
+                return BulkResult(value, exception=e)
+
+        pending = set()
+        for value in values:
+            pending.add(asyncio.ensure_future(work(value)))
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in asyncio.as_completed(pending):
+            yield await future
+
+
+class JsonlGraphWriter:
+    def __init__(self, output: typing.TextIO):
+        self.output = output
+
+    def node(self, node_id: str, kind: str, value, depth: int):
+        self.output.write(json.dumps({'type': 'node', 'id': node_id, 'kind': kind, 'value': value, 'depth': depth}))
+        self.output.write('\n')
+        self.output.flush()
 
-    def by_user_agent(self, user_agent: str) -> typing.List[C2Beacon]:
-        return [
-            C2Beacon.from_response_line(line)
-            for line in self._get(self.base_url + F'/c2/useragent/{url_quote(user_agent)}')
-        ]
+    def edge(self, source: str, target: str):
+        self.output.write(json.dumps({'type': 'edge', 'source': source, 'target': target}))
+        self.output.write('\n')
+        self.output.flush()
+
+    def close(self):
+        self.output.flush()
+
+
+class GraphmlGraphWriter:
+    def __init__(self, output: typing.TextIO):
+        self.output = output
+        self.edges = 0
+        self.output.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+            '  <key id="kind" for="node" attr.name="kind" attr.type="string"/>\n'
+            '  <key id="value" for="node" attr.name="value" attr.type="string"/>\n'
+            '  <key id="depth" for="node" attr.name="depth" attr.type="int"/>\n'
+            '  <graph id="pivot" edgedefault="undirected">\n'
+        )
 
-    def by_tag(self, tag: Tag) -> typing.List[C2Beacon]:
-        return [C2Beacon.from_response_line(line) for line in self._get(self.base_url + F'/c2/tags/{tag}')]
+    def node(self, node_id: str, kind: str, value, depth: int):
+        from xml.sax.saxutils import quoteattr, escape
 
+        self.output.write(
+            F'    <node id={quoteattr(node_id)}><data key="kind">{escape(kind)}</data>'
+            F'<data key="value">{escape(str(value))}</data><data key="depth">{depth}</data></node>\n'
+        )
+        self.output.flush()
+
+    def edge(self, source: str, target: str):
+        from xml.sax.saxutils import quoteattr
+
+        self.edges += 1
+        self.output.write(F'    <edge id="e{self.edges}" source={quoteattr(source)} target={quoteattr(target)}/>\n')
+        self.output.flush()
+
+    def close(self):
+        self.output.write('  </graph>\n</graphml>\n')
+        self.output.flush()
+
+
+class PivotCrawler:
+    """
+    Expands a seed indicator breadth-first through the indicators its beacons share: every lookup kind in `follow`
+    found in a result is looked up in turn, up to `max_depth` hops and at most `budget` lookups. Every indicator is
+    looked up at most once and all lookups of a level run concurrently. The resulting graph is written incrementally.
+    """
+    RELATIONS = {
+        'cookie': lambda beacon: str(beacon.cookie_id) if beacon.cookie_id else None,
+        'actorip': lambda beacon: beacon.actor_ip,
+        'c2': lambda beacon: beacon.c2,
+        'useragent': lambda beacon: beacon.user_agent,
+        'actorasn': lambda beacon: Guesser.guess_numeric_asn_from_organization_string(beacon.actor_asn_organization)
+        if beacon.actor_asn_organization else None,
+        'c2asn': lambda beacon: Guesser.guess_numeric_asn_from_organization_string(beacon.c2_asn_organization)
+        if beacon.c2_asn_organization else None,
+    }
+
+    def __init__(self, client, follow: typing.Iterable[str] = ('cookie', 'actorip', 'c2'), max_depth: int = 2,
+                 budget: int = 100, workers: int = 8):
+        self.client = client
+        self.follow = set(follow)
+        self.max_depth = max_depth
+        self.budget = budget
+        self.workers = workers
 
-class ConsoleHandler(logging.Handler):
-    def emit(self, record):
-        print('[%s] %s' % (record.levelname, record.msg))
+    @staticmethod
+    def node_id(kind: str, value) -> str:
+        return F'{kind}:{value}'
+
+    def crawl(self, kind: str, value, writer) -> typing.Iterator[typing.Tuple[str, BulkResult]]:
+        """Runs the crawl, yielding the kind and result of every lookup as it completes."""
+        import concurrent.futures
+
+        seen_nodes = {(kind, value)}
+        seen_edges = set()
+        writer.node(self.node_id(kind, value), kind, value, 0)
+        frontier = [(kind, value)]
+        lookups = 0
+
+        def work(node):
+            try:
+                return BulkResult(node[1], self.client.lookup(*node))
+            except Exception as e:
+                return BulkResult(node[1], exception=e)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for depth in range(1, self.max_depth + 1):
+                frontier = frontier[:max(self.budget - lookups, 0)]
+                if not frontier:
+                    break
+                lookups += len(frontier)
+                next_frontier = []
+                futures = {executor.submit(work, node): node for node in frontier}
+                for future in concurrent.futures.as_completed(futures):
+                    source_kind, source_value = futures[future]
+                    result = future.result()
+                    yield source_kind, result
+                    if not result.ok:
+                        continue
+                    source_id = self.node_id(source_kind, source_value)
+                    for beacon in result.beacons:
+                        for target_kind, relation in self.RELATIONS.items():
+                            target_value = relation(beacon)
+                            if target_value is None or (target_kind, target_value) == (source_kind, source_value):
+                                continue
+                            target_id = self.node_id(target_kind, target_value)
+                            if (target_kind, target_value) not in seen_nodes:
+                                seen_nodes.add((target_kind, target_value))
+                                writer.node(target_id, target_kind, target_value, depth)
+                                if target_kind in self.follow:
+                                    next_frontier.append((target_kind, target_value))
+                            edge = (source_id, target_id) if source_id < target_id else (target_id, source_id)
+                            if edge not in seen_edges:
+                                seen_edges.add(edge)
+                                writer.edge(source_id, target_id)
+                frontier = next_frontier
+
+
+class NdjsonWatchSink:
+    def __init__(self, output: typing.TextIO):
+        self.output = output
+
+    def emit(self, kind: str, value, beacons: typing.List[C2Beacon]):
+        for beacon in beacons:
+            self.output.write(json.dumps({'kind': kind, 'indicator': value, 'beacon': beacon}, cls=CustomJsonEncoder))
+            self.output.write('\n')
+        self.output.flush()
+
+
+class WebhookWatchSink:
+    """POSTs the new beacons of every poll as one JSON document to the given URL."""
+
+    def __init__(self, url: str, timeout: float = 10):
+        import requests
+
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.session()
 
+    def emit(self, kind: str, value, beacons: typing.List[C2Beacon]):
+        if not beacons:
+            return
+        response = self.session.post(
+            self.url,
+            data=json.dumps({'kind': kind, 'indicator': value, 'beacons': beacons}, cls=CustomJsonEncoder),
+            headers={'Content-Type': 'application/json'},
+            timeout=self.timeout,
+        )
+        if response.status_code >= 300:
+            raise MalBeaconException(F'Webhook "{self.url}" responded with status {response.status_code}')
+
+
+class Watcher:
+    """
+    Polls a set of indicators every `interval` seconds and reports only beacons which were not reported before. Per
+    indicator, it remembers the newest timestamp seen and the fingerprints of the beacons at that timestamp. Polls are
+    spread evenly across the interval and the state can be persisted to survive restarts.
+    """
+
+    def __init__(self, client, indicators: typing.List[typing.Tuple[str, typing.Any]], interval: float,
+                 state_path: str = None):
+        self.client = client
+        self.indicators = indicators
+        self.interval = interval
+        self.state_path = state_path
+        self.state = {}
+        if state_path and os.path.exists(state_path):
+            with open(state_path, 'r') as fp:
+                self.state = json.load(fp)
+
+    def save(self):
+        if not self.state_path:
+            return
+        with open(self.state_path + '.tmp', 'w') as fp:
+            json.dump(self.state, fp)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def poll(self, kind: str, value) -> typing.Tuple[typing.List[C2Beacon], dict]:
+        """
+        Looks up the indicator and returns the beacons not reported before together with the new high-water mark,
+        which is only stored by `commit` once the beacons were delivered.
+        """
+        key = F'{kind}:{value}'
+        high_water_mark = self.state.get(key, {'timestamp': '', 'fingerprints': []})
+        timestamp, fingerprints = high_water_mark['timestamp'], set(high_water_mark['fingerprints'])
+        new_timestamp, new_fingerprints = timestamp, set(fingerprints)
+        new_beacons = []
+        for beacon in self.client.lookup(kind, value):
+            beacon_timestamp = DateTimeFactory.to_str(beacon.timestamp)
+            if beacon_timestamp < timestamp:
+                continue
+            fingerprint = beacon.fingerprint()
+            if beacon_timestamp == timestamp and fingerprint in fingerprints:
+                continue
+            new_beacons.append(beacon)
+            if beacon_timestamp > new_timestamp:
+                new_timestamp, new_fingerprints = beacon_timestamp, set()
+            if beacon_timestamp == new_timestamp:
+                new_fingerprints.add(fingerprint)
+        return new_beacons, {'timestamp': new_timestamp, 'fingerprints': sorted(new_fingerprints)}
+
+    def commit(self, kind: str, value, high_water_mark: dict):
+        self.state[F'{kind}:{value}'] = high_water_mark
+        self.save()
+
+    def run(self, sink, rounds: int = None) -> typing.Iterator[BulkResult]:
+        """Polls for the given number of rounds (forever by default), yielding the result of every poll."""
+        round_number = 0
+        start = time.monotonic()
+        while rounds is None or round_number < rounds:
+            for i, (kind, value) in enumerate(self.indicators):
+                delay = start + (round_number + float(i) / len(self.indicators)) * self.interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    beacons, high_water_mark = self.poll(kind, value)
+                    sink.emit(kind, value, beacons)
+                except Exception as e:
+                    yield BulkResult(value, exception=e)
+                    continue
+                self.commit(kind, value, high_water_mark)
+                yield BulkResult(value, beacons)
+            round_number += 1
+
+
+class ShardedBulkRunner:
+    """
+    Looks up very large lists of indicators on `processes` worker processes, spreading the decoding over several CPUs.
+    The values are split into shards of `shard_size`, each of which is looked up by one process on `workers` threads
+    with its own client, created once per process by the picklable `client_factory`. If given, the `rate_limiter`
+    (usually a `SharedRateLimiter`) replaces those of the clients, so all processes share one budget.
+
+    Finished shards are written to `checkpoint_dir` atomically and a rerun with the same directory and values only
+    looks up the shards which have not been finished or had failing lookups. Results are yielded in the order of the
+    values and every beacon is reported only once, with the first value it was found for. With `serialized`, the
+    beacons of the results are their JSON serializations instead of `C2Beacon` objects, which saves decoding them a
+    second time in the main process.
+    """
+    SHARD_SIZE = 1000
+    # set in every worker process by _initialize
+    client = None
+
+    def __init__(self, client_factory: typing.Callable[[], 'MalBeaconClient'], kind: str, processes: int = None,
+                 shard_size: int = SHARD_SIZE, workers: int = 8, checkpoint_dir: str = None,
+                 rate_limiter: RateLimiter = None, **query):
+        if kind not in MalBeaconClient.LOOKUPS:
+            raise MalBeaconException(F'Unknown lookup kind: {kind}')
+        self.client_factory = client_factory
+        self.kind = kind
+        self.processes = processes or os.cpu_count()
+        self.shard_size = shard_size
+        self.workers = workers
+        self.checkpoint_dir = checkpoint_dir
+        self.rate_limiter = rate_limiter
+        self.query = query
+        if checkpoint_dir and self._conditions(query.get('predicate')) is NotImplemented:
+            raise MalBeaconException('Checkpoints only support predicates built with BeaconQuery.equals')
 
-def main():
-    import platform
+    @staticmethod
+    def _conditions(predicate: typing.Callable = None):
+        """The conditions of a predicate built by `BeaconQuery.equals`, NotImplemented for any other predicate."""
+        if predicate is None:
+            return None
+        if not isinstance(predicate, functools.partial) or predicate.func is not BeaconQuery._matches:
+            return NotImplemented
+        return sorted(predicate.args[0])
 
-    parser = argparse.ArgumentParser()
-    subparsers = parser.add_subparsers(dest='command')
+    @staticmethod
+    def _initialize(client_factory: typing.Callable, rate_limiter: RateLimiter):
+        ShardedBulkRunner.client = client_factory()
+        if rate_limiter is not None:
+            ShardedBulkRunner.client.rate_limiter = rate_limiter
 
-    cookie_id_parser = subparsers.add_parser('cookie', help='List beacons of specified cookie ID.')
-    cookie_id_parser.add_argument('cookie_id')
+    @staticmethod
+    def _shard_path(directory: str, index: int, failed: bool = False) -> str:
+        return os.path.join(directory, F'shard-{index:06}{".failed" if failed else ""}.tsv')
 
-    c2ip_parser = subparsers.add_parser('c2ip', help='List beacons of specified C2 IP.')
-    c2ip_parser.add_argument('ip')
+    @staticmethod
+    def _run_shard(directory: str, index: int, kind: str, values: list, workers: int, query: dict):
+        """
+        Looks up the values of a shard and writes their results to the shard's file: one line per value, holding the
+        value and the error of its lookup, followed by one line per beacon, holding its fingerprint and the beacon.
+        """
+        import hashlib
+
+        results = {}
+        for result in ShardedBulkRunner.client.lookup_many(kind, values, workers=workers, **query):
+            results[result.value] = result
+        fields = BeaconQuery(**query).fields
+
+        failed = not all(result.ok for result in results.values())
+        path = ShardedBulkRunner._shard_path(directory, index, failed)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for value in dict.fromkeys(values):
+                result = results[value]
+                f.write(F'#\t{json.dumps(value)}\t{json.dumps(None if result.ok else str(result.exception))}\n')
+                for beacon in result.beacons or []:
+                    record = beacon.to_dict()
+                    if fields is not None:
+                        record = {field: record[field] for field in fields}
+                    # the serialization covers all (requested) fields, so its hash doubles as fingerprint
+                    data = json.dumps(record)
+                    f.write(F'{hashlib.sha1(data.encode("utf-8")).hexdigest()}\t{data}\n')
+        os.replace(path + '.tmp', path)
+        if not failed and os.path.exists(ShardedBulkRunner._shard_path(directory, index, True)):
+            os.remove(ShardedBulkRunner._shard_path(directory, index, True))
+
+    def _read_shard(self, directory: str, index: int, seen: set, serialized: bool) -> typing.Iterator[BulkResult]:
+        path = self._shard_path(directory, index)
+        if not os.path.exists(path):
+            path = self._shard_path(directory, index, True)
+        result = None
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                marker, _, data = line.rstrip('\n').partition('\t')
+                if marker == '#':
+                    if result is not None:
+                        yield result
+                    value, _, error = data.partition('\t')
+                    error = json.loads(error)
+                    result = BulkResult(json.loads(value), exception=MalBeaconException(error)) if error \
+                        else BulkResult(json.loads(value), [])
+                elif marker not in seen:
+                    seen.add(marker)
+                    result.beacons.append(data if serialized else C2Beacon.from_dict(json.loads(data)))
+        if result is not None:
+            yield result
+
+    def _check_manifest(self, directory: str, values: list):
+        import hashlib
+
+        query = BeaconQuery(**self.query)
+        manifest = {
+            'kind': self.kind,
+            'shard_size': self.shard_size,
+            'values': len(values),
+            'digest': hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest(),
+            'query': {
+                'fields': query.fields, 'since': query.since, 'until': query.until,
+                'where': self._conditions(query.predicate),
+            },
+        }
+        path = os.path.join(directory, 'manifest.json')
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                if json.load(f) != json.loads(json.dumps(manifest)):
+                    raise MalBeaconException(F'Checkpoint directory {directory} belongs to a different run')
+            return
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + '.tmp', path)
+
+    def run(self, values: typing.Iterable, serialized: bool = False) -> typing.Iterator[BulkResult]:
+        import concurrent.futures
+        import itertools
+        import shutil
+        import tempfile
+
+        values = list(values)
+        directory = self.checkpoint_dir or tempfile.mkdtemp(prefix='malbeacon-')
+        try:
+            os.makedirs(directory, exist_ok=True)
+            self._check_manifest(directory, values)
+            shards = [values[i:i + self.shard_size] for i in range(0, len(values), self.shard_size)]
+            finished = {i for i in range(len(shards)) if os.path.exists(self._shard_path(directory, i))}
+            seen, next_index = set(), 0
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.processes, initializer=self._initialize,
+                initargs=(self.client_factory, self.rate_limiter)
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        self._run_shard, directory, i, self.kind, shard, self.workers, self.query
+                    ): i for i, shard in enumerate(shards) if i not in finished
+                }
+                # shards finish in any order, but are merged in order
+                for future in itertools.chain([None], concurrent.futures.as_completed(futures)):
+                    if future is not None:
+                        future.result()
+                        finished.add(futures[future])
+                    while next_index in finished:
+                        yield from self._read_shard(directory, next_index, seen, serialized)
+                        next_index += 1
+        finally:
+            if self.checkpoint_dir is None:
+                shutil.rmtree(directory, ignore_errors=True)
+
+
+def open_output(path: str, compression: str = None) -> typing.BinaryIO:
+    """Opens a binary output file ("-" for stdout), optionally compressed with "gzip" or "zstd"."""
+    if compression == 'gzip':
+        import gzip
+
+        if path not in (None, '-'):
+            return gzip.open(path, 'wb')
+        return gzip.GzipFile(fileobj=open_output(path), mode='wb')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise MalBeaconException('Compressing with zstd requires the package "zstandard" to be installed')
+        return zstandard.ZstdCompressor().stream_writer(open_output(path))
+    if compression:
+        raise MalBeaconException(F'Unknown compression: {compression}')
+    if path in (None, '-'):
+        # closing this does not close stdout itself, so it can be handed out like any other file
+        sys.stdout.flush()
+        return open(sys.stdout.fileno(), 'wb', closefd=False)
+    return open(path, 'wb')
+
+
+class Exporter:
+    """
+    Base of all exporters, which buffer beacons and write them to a binary output in batches. With a `batch_size` of
+    1, every beacon is flushed to the output right away instead. Closing the exporter closes the output as well. If
+    `fields` is given, only these attributes of the beacons are written.
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, output: typing.BinaryIO, batch_size: int = None, fields: typing.Sequence[str] = None):
+        self.output = output
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.fields = fields
+        self.batch = []
+        self.count = 0
+
+    def write(self, beacon: C2Beacon):
+        self.batch.append(beacon)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, beacons: typing.Iterable[C2Beacon]):
+        for beacon in beacons:
+            self.write(beacon)
+
+    def flush(self):
+        if self.batch:
+            self._write_batch(self.batch)
+            self.count += len(self.batch)
+            self.batch = []
+            if self.batch_size == 1:
+                self.output.flush()
+
+    def _write_batch(self, beacons: typing.List[C2Beacon]):
+        raise NotImplementedError()
+
+    def _finish(self):
+        pass
+
+    def close(self):
+        self.flush()
+        self._finish()
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NdjsonExporter(Exporter):
+    def write_serialized(self, lines: typing.List[str]):
+        """Writes beacons which are already serialized to JSON, e.g. by `ShardedBulkRunner`."""
+        self.flush()
+        self.output.write(''.join([line + '\n' for line in lines]).encode('utf-8'))
+        self.count += len(lines)
+        if self.batch_size == 1:
+            self.output.flush()
+
+    def _write_batch(self, beacons: typing.List[C2Beacon]):
+        dumps = json.dumps
+        if self.fields is not None:
+            fields = self.fields
+            dicts = ({field: values[field] for field in fields} for values in map(C2Beacon.to_dict, beacons))
+        else:
+            dicts = map(C2Beacon.to_dict, beacons)
+        self.output.write(''.join([dumps(values) + '\n' for values in dicts]).encode('utf-8'))
 
-    c2_parser = subparsers.add_parser('c2', help='List beacons of specified C2 IP.')
-    c2_parser.add_argument('c2')
 
-    c2city_parser = subparsers.add_parser('c2city', help='List beacons of specified C2 IP.')
-    c2city_parser.add_argument('city')
+class CsvExporter(Exporter):
+    COLUMNS = (
+        'timestamp', 'actor_asn_organization', 'actor_city', 'actor_country_code', 'actor_hostname', 'actor_ip',
+        'actor_latitude', 'actor_longitude', 'actor_region', 'actor_timezone', 'c2', 'c2_asn_organization', 'c2_city',
+        'c2_country_code', 'c2_domain', 'c2_domain_resolved', 'c2_hostname', 'c2_latitude', 'c2_longitude',
+        'c2_region', 'c2_timezone', 'cookie_id', 'user_agent', 'tags',
+    )
 
-    c2country_parser = subparsers.add_parser('c2country', help='List beacons of specified C2 IP.')
-    c2country_parser.add_argument('country')
+    def __init__(self, output: typing.BinaryIO, batch_size: int = None, fields: typing.Sequence[str] = None):
+        import csv
+        import io
 
-    c2asn_parser = subparsers.add_parser('c2asn', help='List beacons of specified C2 IP.')
-    c2asn_parser.add_argument('asn', type=Guesser.guess_numeric_asn_from_organization_string)
+        super().__init__(output, batch_size, fields)
+        self.columns = self.COLUMNS if fields is None else self.columns_of(fields)
+        self.indices = None if fields is None else [self.COLUMNS.index(column) for column in self.columns]
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.writer.writerow(self.columns)
 
-    actorip_parser = subparsers.add_parser('actorip', help='List beacons of specified C2 IP.')
-    actorip_parser.add_argument('ip')
+    @staticmethod
+    def columns_of(fields: typing.Sequence[str]) -> typing.List[str]:
+        """Columns of the given fields, locations are split into latitude and longitude."""
+        columns = []
+        for field in fields:
+            if field.endswith('_location'):
+                prefix = field[:-len('_location')]
+                columns.extend([F'{prefix}_latitude', F'{prefix}_longitude'])
+            else:
+                columns.append(field)
+        return columns
+
+    def _write_batch(self, beacons: typing.List[C2Beacon]):
+        rows = []
+        for beacon in beacons:
+            actor_location, c2_location = beacon.actor_location, beacon.c2_location
+            rows.append((
+                DateTimeFactory.to_str(beacon.timestamp) if beacon.timestamp else None,
+                beacon.actor_asn_organization, beacon.actor_city,
+                beacon.actor_country_code, beacon.actor_hostname, beacon.actor_ip,
+                actor_location.latitude if actor_location else None,
+                actor_location.longitude if actor_location else None,
+                beacon.actor_region, beacon.actor_timezone, beacon.c2, beacon.c2_asn_organization, beacon.c2_city,
+                beacon.c2_country_code, beacon.c2_domain, beacon.c2_domain_resolved, beacon.c2_hostname,
+                c2_location.latitude if c2_location else None, c2_location.longitude if c2_location else None,
+                beacon.c2_region, beacon.c2_timezone, str(beacon.cookie_id) if beacon.cookie_id else None,
+                beacon.user_agent, ','.join(tag.value for tag in beacon.tags) if beacon.tags is not None else None,
+            ))
+        if self.indices is not None:
+            indices = self.indices
+            rows = [[row[index] for index in indices] for row in rows]
+        self.writer.writerows(rows)
+        self.output.write(self.buffer.getvalue().encode('utf-8'))
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def _finish(self):
+        # the header is still buffered if there were no beacons at all
+        self.output.write(self.buffer.getvalue().encode('utf-8'))
+
+
+class ParquetExporter(Exporter):
+    """Writes one Parquet row group per batch, using Parquet's own compression instead of compressing the file."""
+    BATCH_SIZE = 64 * 1024
+
+    def __init__(self, output: typing.BinaryIO, batch_size: int = None, compression: str = 'snappy',
+                 fields: typing.Sequence[str] = None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise MalBeaconException('Exporting to Parquet requires the package "pyarrow" to be installed')
+        super().__init__(output, batch_size, fields)
+        self.pyarrow = pyarrow
+        string, integer = pyarrow.string(), pyarrow.int64()
+        self.all_columns = [column for column in CsvExporter.COLUMNS if column not in ('timestamp', 'tags')] \
+            + ['timestamp', 'tags']
+        columns = self.all_columns if fields is None else set(CsvExporter.columns_of(fields))
+        self.schema = pyarrow.schema([
+            (column, integer if column.endswith(('_latitude', '_longitude')) else string)
+            for column in self.all_columns if column in columns and column not in ('timestamp', 'tags')
+        ] + [
+            (column, pyarrow.timestamp('s') if column == 'timestamp' else pyarrow.list_(string))
+            for column in ('timestamp', 'tags') if column in columns
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(output, self.schema, compression=compression)
+
+    def _write_batch(self, beacons: typing.List[C2Beacon]):
+        columns = {name: [] for name in self.all_columns}
+        for beacon in beacons:
+            for name in ('actor_asn_organization', 'actor_city', 'actor_country_code', 'actor_hostname', 'actor_ip',
+                         'actor_region', 'actor_timezone', 'c2', 'c2_asn_organization', 'c2_city', 'c2_country_code',
+                         'c2_domain', 'c2_domain_resolved', 'c2_hostname', 'c2_region', 'c2_timezone', 'user_agent'):
+                columns[name].append(getattr(beacon, name))
+            for prefix, location in (('actor', beacon.actor_location), ('c2', beacon.c2_location)):
+                columns[prefix + '_latitude'].append(location.latitude if location else None)
+                columns[prefix + '_longitude'].append(location.longitude if location else None)
+            columns['cookie_id'].append(str(beacon.cookie_id) if beacon.cookie_id else None)
+            columns['timestamp'].append(beacon.timestamp)
+            columns['tags'].append([tag.value for tag in beacon.tags] if beacon.tags is not None else None)
+        self.writer.write_table(self.pyarrow.Table.from_pydict(
+            {name: columns[name] for name in self.schema.names}, schema=self.schema
+        ))
+
+    def _finish(self):
+        self.writer.close()
+
+
+EXPORTERS = {
+    'ndjson': NdjsonExporter,
+    'csv': CsvExporter,
+    'parquet': ParquetExporter,
+}
+
+
+def open_exporter(args, fields: typing.Sequence[str] = None) -> Exporter:
+    if args.format == 'parquet':
+        return ParquetExporter(open_output(args.output), compression=args.compression or 'snappy', fields=fields)
+    # on uncompressed stdout, every beacon is output as soon as it is decoded
+    batch_size = 1 if args.output in (None, '-') and not args.compression else None
+    return EXPORTERS[args.format](open_output(args.output, args.compression), batch_size=batch_size, fields=fields)
+
+
+def create_client(args, metrics: Metrics = None) -> MalBeaconClient:
+    """Creates a client, its cache and store as configured by the global command line arguments."""
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(
+            args.cache_file,
+            ttls={endpoint: args.cache_ttl for endpoint in ResponseCache.DEFAULT_TTLS} if args.cache_ttl else None,
+            default_ttl=args.cache_ttl or ResponseCache.DEFAULT_TTL,
+            max_entries=args.cache_size,
+            refresh=args.refresh,
+            offline=args.offline,
+        )
+    store = None if args.no_store and not args.local else BeaconStore(args.store)
+    pool_size = args.pool_size or max(getattr(args, 'workers', 1), 10)
+    return MalBeaconClient(
+        args.api_key, args.user_agent, args.base_url, cache=cache,
+        rate_limiter=RateLimiter(args.rate, args.burst) if args.rate else None,
+        retry_policy=RetryPolicy(retries=args.retries), store=store,
+        pool_size=pool_size, connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+        transport=HttpxTransport(pool_size, args.connect_timeout, args.read_timeout) if args.http2 else None,
+        single_flight=SingleFlight(args.memo_ttl), metrics=metrics,
+    )
 
-    actorhostname_parser = subparsers.add_parser('actorhostname', help='List beacons of specified C2 IP.')
-    actorhostname_parser.add_argument('hostname')
 
-    actorcity_parser = subparsers.add_parser('actorcity', help='List beacons of specified C2 IP.')
-    actorcity_parser.add_argument('city')
+def main():
+    import argparse
 
-    actorcountry_parser = subparsers.add_parser('actorcountry', help='List beacons of specified C2 IP.')
-    actorcountry_parser.add_argument('country')
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
 
-    actorasn_parser = subparsers.add_parser('actorasn', help='List beacons of specified C2 IP.')
-    actorasn_parser.add_argument('asn', type=Guesser.guess_numeric_asn_from_organization_string)
+    for kind, _, _, _, argument, description in MalBeaconClient.ENDPOINTS:
+        lookup_parser = subparsers.add_parser(kind, help=F'List beacons of specified {description}.')
+        if argument == 'asn':
+            lookup_parser.add_argument(argument, type=Guesser.guess_numeric_asn_from_organization_string)
+        else:
+            lookup_parser.add_argument(argument)
 
-    useragent_parser = subparsers.add_parser('useragent', help='List beacons of specified C2 IP.')
-    useragent_parser.add_argument('user_agent')
+    bulk_parser = subparsers.add_parser('bulk', help='Look up many indicators of the same kind concurrently.')
+    bulk_parser.add_argument('kind', choices=list(MalBeaconClient.LOOKUPS.keys()))
+    bulk_parser.add_argument(
+        'input', nargs='?', type=argparse.FileType('r'), default=sys.stdin,
+        help='File with one indicator per line, defaults to stdin.'
+    )
+    bulk_parser.add_argument(
+        '--workers', type=int, default=8, help='Number of concurrent lookups (per process with --processes).'
+    )
+    bulk_parser.add_argument(
+        '--processes', type=int, default=1, help='Number of worker processes to spread the lookups across.'
+    )
+    bulk_parser.add_argument(
+        '--shard-size', type=int, default=ShardedBulkRunner.SHARD_SIZE,
+        help='Number of indicators a worker process looks up at once.'
+    )
+    bulk_parser.add_argument(
+        '--checkpoint-dir', help='Directory to keep finished shards in, so an interrupted run can be resumed.'
+    )
 
-    tag_parser = subparsers.add_parser('tag', help='List beacons of specified C2 IP.')
-    tag_parser.add_argument('tag')
+    watch_parser = subparsers.add_parser('watch', help='Periodically poll indicators and emit only new beacons.')
+    watch_parser.add_argument(
+        'input', nargs='?', type=argparse.FileType('r'), default=sys.stdin,
+        help='File with one "<kind> <indicator>" pair per line, defaults to stdin.'
+    )
+    watch_parser.add_argument('--interval', type=float, default=900, help='Seconds between polls of an indicator.')
+    watch_parser.add_argument('--state', help='File to persist the last seen beacons in across restarts.')
+    watch_parser.add_argument('--webhook', help='POST new beacons to this URL instead of printing them.')
+    watch_parser.add_argument('--rounds', type=int, help='Stop after polling every indicator this many times.')
+
+    pivot_parser = subparsers.add_parser('pivot', help='Crawl the graph of indicators related to the given one.')
+    pivot_parser.add_argument('kind', choices=list(MalBeaconClient.LOOKUPS.keys()))
+    pivot_parser.add_argument('value')
+    pivot_parser.add_argument('--depth', type=int, default=2, help='Maximum number of hops from the seed.')
+    pivot_parser.add_argument('--budget', type=int, default=100, help='Maximum number of lookups.')
+    pivot_parser.add_argument(
+        '--follow', default='cookie,actorip,c2',
+        help=F'Comma-separated kinds of indicators to expand, out of: {",".join(PivotCrawler.RELATIONS.keys())}.'
+    )
+    pivot_parser.add_argument('--workers', type=int, default=8, help='Number of concurrent lookups.')
+    pivot_parser.add_argument('--graph-format', choices=['jsonl', 'graphml'], default='jsonl')
 
     parser.add_argument('--debug', action='store_true')
-    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--stats', action='store_true', help='Print per-endpoint request and decoding statistics.')
+    parser.add_argument('--metrics-file', help='Write metrics in the Prometheus text format to this file.')
+    parser.add_argument('--json', action='store_true', help='Shorthand for --format ndjson.')
+    parser.add_argument('--format', choices=['table'] + list(EXPORTERS.keys()), default='table')
+    parser.add_argument(
+        '--gap', type=float, default=3600,
+        help='Seconds between two beacons of a cookie ID, actor IP and C2 that start a new session in the table.'
+    )
+    parser.add_argument('--output', default='-', help='File to write results to, defaults to stdout.')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], help='Compress the output file.')
+    parser.add_argument(
+        '--fields', help=F'Comma-separated fields to export, out of: {",".join(C2Beacon.FIELDS)}.'
+    )
+    parser.add_argument('--since', help='Only beacons at or after this "YYYY-MM-DD[ HH:MM:SS]" timestamp.')
+    parser.add_argument('--until', help='Only beacons before this "YYYY-MM-DD[ HH:MM:SS]" timestamp.')
+    parser.add_argument(
+        '--where', action='append', default=[], metavar='FIELD=VALUE',
+        help='Only beacons with the given value of a field, may be repeated.'
+    )
     parser.add_argument('--api-key', default=os.environ.get('MALBEACON_API_KEY'))
     parser.add_argument('--base-url', default='https://api.malbeacon.com/v1')
     parser.add_argument(
-        '--user-agent',
-        default=F'MalBeaconClient/{__version__} (python-requests {requests.__version__}) '
-                F'{platform.system()} ({platform.release()})'
+        '--cache-file',
+        default=os.environ.get(
+            'MALBEACON_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'malbeacon', 'cache.sqlite')
+        )
+    )
+    parser.add_argument('--cache-ttl', type=float, help='Override the cache TTL (seconds) of all endpoints.')
+    parser.add_argument('--cache-size', type=int, default=10000, help='Maximum number of cached responses.')
+    parser.add_argument(
+        '--store',
+        default=os.environ.get(
+            'MALBEACON_STORE', os.path.join(os.path.expanduser('~'), '.local', 'share', 'malbeacon', 'beacons.sqlite')
+        ),
+        help='Database all fetched beacons are collected in.'
+    )
+    parser.add_argument('--no-store', action='store_true', help='Do not collect fetched beacons in the database.')
+    parser.add_argument('--local', action='store_true', help='Answer lookups from the collected beacons only.')
+    parser.add_argument('--rate', type=float, help='Maximum number of requests per second.')
+    parser.add_argument('--burst', type=int, default=1, help='Number of requests allowed in a burst above --rate.')
+    parser.add_argument('--retries', type=int, default=3, help='Retries on rate limiting, server errors and timeouts.')
+    parser.add_argument(
+        '--pool-size', type=int, help='Connections kept alive per host, defaults to --workers, but at least 10.'
+    )
+    parser.add_argument('--connect-timeout', type=float, default=5)
+    parser.add_argument('--read-timeout', type=float, default=5)
+    parser.add_argument('--http2', action='store_true', help='Use HTTP/2 (requires the package "httpx[http2]").')
+    parser.add_argument(
+        '--memo-ttl', type=float, default=0, help='Seconds to reuse the result of a lookup for identical lookups.'
+    )
+    parser.add_argument('--no-cache', action='store_true', help='Neither read from nor write to the response cache.')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached responses, but update the cache.')
+    parser.add_argument('--offline', action='store_true', help='Only answer from the cache, ignoring TTLs.')
+    parser.add_argument(
+        '--user-agent', help='Defaults to "MalBeaconClient/<version> (python-requests <version>) <system> (<release>)".'
     )
     args = parser.parse_args()
+    if args.json:
+        args.format = 'ndjson'
+    query = {}
+    if args.fields:
+        query['fields'] = args.fields.split(',')
+    if args.since:
+        query['since'] = args.since
+    if args.until:
+        query['until'] = args.until
+    if args.where:
+        conditions = dict(condition.partition('=')[::2] for condition in args.where)
+        try:
+            query['predicate'] = BeaconQuery.equals(**conditions)
+        except MalBeaconException as e:
+            parser.error(str(e))
+    try:
+        fields = BeaconQuery(**query).fields
+    except MalBeaconException as e:
+        parser.error(str(e))
+    if fields is not None and args.format == 'table':
+        parser.error('--fields requires --format ndjson, csv or parquet')
+    if query and args.command in ['watch', 'pivot']:
+        parser.error(F'--fields, --since, --until and --where are not supported by {args.command}')
+    if args.command == 'bulk' and (args.processes > 1 or args.checkpoint_dir):
+        if args.local:
+            parser.error('--processes and --checkpoint-dir cannot be combined with --local')
+        if args.stats or args.metrics_file:
+            parser.error('--stats and --metrics-file are not supported with --processes or --checkpoint-dir')
 
     logger = logging.getLogger('MalBeacon')
     logger.handlers.append(ConsoleHandler())
@@ -409,88 +2925,149 @@ def main():
         import http.client as http_client
         http_client.HTTPConnection.debuglevel = 1
 
-    logger.debug(F'Using User-Agent string: {args.user_agent}')
-    client = MalBeaconClient(args.api_key, args.user_agent, args.base_url)
+    if args.debug:
+        logger.debug(F'Using User-Agent string: {args.user_agent or MalBeaconClient.default_user_agent()}')
+    metrics = Metrics() if args.stats or args.metrics_file else None
+    client = create_client(args, metrics)
+    cache, store = client.cache, client.store
+    if args.local:
+        client = store
     try:
-        if args.command in [
-            'cookie', 'c2ip', 'c2', 'c2city', 'c2country', 'c2asn', 'actorip', 'actorhostname', 'actorcity',
-            'actorcountry', 'actorasn', 'useragent', 'tag'
-        ]:
-            table_data = [['Timestamp', 'Actor IP', 'C2 URL']]
-            user_agents = []
-            c2_asns = []
-            actor_asns = []
-            tags = []
-            reduced_data = False
-            activity_timestamps = []
-            for c2_beacon in {
-                'cookie': lambda: client.by_cookie_id(CookieId(args.cookie_id)),
-                'c2ip': lambda: client.by_c2_ip(args.ip),
-                'c2': lambda: client.by_c2(args.c2),
-                'c2city': lambda: client.by_c2_city(args.city),
-                'c2country': lambda: client.by_c2_country(args.country),
-                'c2asn': lambda: client.by_c2_asn(args.asn),
-                'actorip': lambda: client.by_actor_ip(args.ip),
-                'actorhostname': lambda: client.by_actor_hostname(args.hostname),
-                'actorcity': lambda: client.by_actor_city(args.city),
-                'actorcountry': lambda: client.by_actor_country(args.country),
-                'actorasn': lambda: client.by_actor_asn(args.asn),
-                'useragent': lambda: client.by_user_agent(args.user_agent),
-                'tag': lambda: client.by_tag(Tag(args.tag)),
-            }[args.command]():
-                if args.json:
-                    print(json.dumps(c2_beacon, cls=CustomJsonEncoder))
+        if args.command in MalBeaconClient.LOOKUPS:
+            beacons = []
+            exporter = None if args.format == 'table' else open_exporter(args, fields)
+            lookup = getattr(client, 'iter_' + MalBeaconClient.LOOKUPS[args.command])
+            argument = MalBeaconClient.LOOKUP_ARGUMENTS[args.command]
+            for c2_beacon in lookup(getattr(args, argument), **query):
+                if exporter is not None:
+                    exporter.write(c2_beacon)
                 else:
-                    activity_timestamps.append(c2_beacon.timestamp)
-                    if c2_beacon.user_agent and c2_beacon.user_agent not in user_agents:
-                        user_agents.append(c2_beacon.user_agent)
-                    if c2_beacon.actor_asn_organization and c2_beacon.actor_asn_organization not in actor_asns:
-                        actor_asns.append(c2_beacon.actor_asn_organization)
-                    if c2_beacon.c2_asn_organization and c2_beacon.c2_asn_organization not in c2_asns:
-                        c2_asns.append(c2_beacon.c2_asn_organization)
-                    if c2_beacon.tags:
-                        for tag in c2_beacon.tags:
-                            if tag.value not in tags:
-                                tags.append(tag.value)
-                    if table_data \
-                            and table_data[len(table_data) - 1][1] == c2_beacon.actor_ip \
-                            and table_data[len(table_data) - 1][2] == c2_beacon.c2:
-                        reduced_data = True
-                        continue
-
-                    table_data.append([
-                        DateTimeFactory.to_date_str(c2_beacon.timestamp),
-                        c2_beacon.actor_ip,
-                        c2_beacon.c2
-                    ])
+                    beacons.append(c2_beacon)
 
-            if not args.json:
+            if exporter is not None:
+                exporter.close()
+            else:
                 from terminaltables import GithubFlavoredMarkdownTable as TerminalTable
+                frame = BeaconFrame.from_beacons(beacons)
+                # the summarizer needs the beacons in order, which the API does not guarantee
+                beacons.sort(key=lambda beacon: beacon.timestamp)
+                summarizer = TimelineSummarizer(args.gap)
+                sessions = [session for beacon in beacons for session in summarizer.add(beacon)] + summarizer.close()
+                del beacons
+                sessions.sort(key=lambda session: session.first_seen)
+                # the cookie ID only tells sessions apart if there is more than one
+                with_cookie_id = len(frame.unique('cookie_id')) > 1
+                table_data = [
+                    ['First seen', 'Last seen', 'Beacons'] + (['Cookie ID'] if with_cookie_id else []) +
+                    ['Actor IP', 'C2 URL']
+                ]
+                for session in sessions:
+                    table_data.append(
+                        [DateTimeFactory.to_str(session.first_seen), DateTimeFactory.to_str(session.last_seen),
+                         session.count] + ([session.cookie_id] if with_cookie_id else []) +
+                        [session.actor_ip, session.c2]
+                    )
                 print(TerminalTable(table_data=table_data).table)
                 print('')
-                Printer.list('User-Agents', user_agents)
-                Printer.list('C2 ASNs', c2_asns)
-                Printer.list('Actor ASNs', actor_asns)
-                Printer.list('Tags', tags)
-                if activity_timestamps:
-                    print(F'First Active: {DateTimeFactory.to_str(min(activity_timestamps))}')
-                    print(F'Last Active: {DateTimeFactory.to_str(max(activity_timestamps))}')
-                    print('')
-                    print('Time of day histogram:')
-                    hours = {}
-                    for dt in activity_timestamps:
-                        hour = int(dt.strftime('%H'), 10)
-                        if hour not in hours.keys():
-                            hours[hour] = 0
-                        hours[hour] += 1
-                    Printer.histogram(hours)
-                if reduced_data:
-                    logger.info('Some data was for clarity reasons, specify --json to dump everything.')
+                Printer.summary(frame)
+                if len(sessions) < summarizer.beacons:
+                    logger.info(
+                        F'{summarizer.beacons} beacons ({summarizer.duplicates} repeated) were summarized into '
+                        F'{len(sessions)} sessions, specify --json to dump everything.'
+                    )
+        elif args.command == 'pivot':
+            value = args.value
+            if args.kind in ['c2asn', 'actorasn']:
+                value = Guesser.guess_numeric_asn_from_organization_string(value)
+            crawler = PivotCrawler(
+                client, follow=args.follow.split(','), max_depth=args.depth, budget=args.budget, workers=args.workers
+            )
+            output = io.TextIOWrapper(open_output(args.output, args.compression), encoding='utf-8')
+            writer = {'jsonl': JsonlGraphWriter, 'graphml': GraphmlGraphWriter}[args.graph_format](output)
+            try:
+                for kind, result in crawler.crawl(args.kind, value, writer):
+                    if result.ok:
+                        logger.debug(F'{kind} {result.value}: {len(result.beacons)} beacons')
+                    else:
+                        logger.error(F'{kind} {result.value}: {result.exception}')
+            finally:
+                writer.close()
+                output.close()
+        elif args.command == 'watch':
+            if cache is not None:
+                # every poll has to see the current state of the API
+                cache.refresh = True
+            indicators = []
+            for line in args.input:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                kind, _, value = line.partition(' ')
+                if kind not in MalBeaconClient.LOOKUPS or not value.strip():
+                    parser.error(F'Invalid indicator line, expected "<kind> <value>": {line}')
+                value = value.strip()
+                if kind in ['c2asn', 'actorasn']:
+                    value = Guesser.guess_numeric_asn_from_organization_string(value)
+                indicators.append((kind, value))
+            if not indicators:
+                parser.error('No indicators to watch.')
+            watcher = Watcher(client, indicators, args.interval, state_path=args.state)
+            sink = WebhookWatchSink(args.webhook) if args.webhook else NdjsonWatchSink(sys.stdout)
+            for result in watcher.run(sink, rounds=args.rounds):
+                if result.ok:
+                    logger.debug(F'{result.value}: {len(result.beacons)} new beacons')
+                else:
+                    logger.error(F'{result.value}: {result.exception}')
+                if args.metrics_file:
+                    metrics.write_prometheus(args.metrics_file)
+        elif args.command == 'bulk':
+            indicators = (line.strip() for line in args.input)
+            indicators = (indicator for indicator in indicators if indicator and not indicator.startswith('#'))
+            if args.kind in ['c2asn', 'actorasn']:
+                indicators = (Guesser.guess_numeric_asn_from_organization_string(i) for i in indicators)
+            exporter = None if args.format == 'table' else open_exporter(args, fields)
+            if args.processes > 1 or args.checkpoint_dir:
+                # everything but the open input file is picklable and handed to the worker processes
+                client_args = argparse.Namespace(**{key: value for key, value in vars(args).items() if key != 'input'})
+                runner = ShardedBulkRunner(
+                    functools.partial(create_client, client_args), args.kind, processes=args.processes,
+                    shard_size=args.shard_size, workers=args.workers, checkpoint_dir=args.checkpoint_dir,
+                    rate_limiter=SharedRateLimiter(args.rate, args.burst) if args.rate else None, **query
+                )
+                # NDJSON lines are passed through as serialized by the workers
+                serialized = args.format == 'ndjson'
+                results = runner.run(indicators, serialized=serialized)
+            else:
+                serialized = False
+                results = client.lookup_many(args.kind, indicators, workers=args.workers, **query)
+            for result in results:
+                if not result.ok:
+                    logger.error(F'{result.value}: {result.exception}')
+                elif serialized:
+                    exporter.write_serialized(result.beacons)
+                elif exporter is not None:
+                    exporter.write_many(result.beacons)
+                else:
+                    print(F'{result.value}: {len(result.beacons)} beacons')
+                    sys.stdout.flush()
+            if exporter is not None:
+                exporter.close()
     except MalBeaconUnauthorizedException as e:
         logger.error('Not authorized! Make sure to specified the correct API-Key.')
         logger.exception(e)
     except MalBeaconException as e:
         logger.exception(e)
+    finally:
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file)
+        if args.stats:
+            from terminaltables import GithubFlavoredMarkdownTable as TerminalTable
+            print(TerminalTable(table_data=metrics.summary()).table, file=sys.stderr)
+        if cache is not None:
+            logger.debug(F'Response cache: {cache.hits} hits, {cache.misses} misses')
+            cache.close()
+        if store is not None:
+            store.close()
 
 
 if __name__ == '__main__':
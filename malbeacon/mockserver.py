@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import datetime
+import json
+import random
+import threading
+import time
+import typing
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote as url_unquote
+
+
+class SyntheticBeacons:
+    """Generates API response lines which look like real ones: few actors, C2s, user agents, ASNs and locations."""
+
+    START = datetime.datetime(2020, 1, 1)
+
+    def __init__(self, seed: int = 0, cardinality: int = 50):
+        self.random = random.Random(seed)
+        self.cardinality = cardinality
+
+    def _pick(self, prefix: str) -> str:
+        return F'{prefix}{self.random.randrange(self.cardinality)}'
+
+    def line(self, i: int) -> dict:
+        return {
+            # ascending like the results of the API, a few minutes apart
+            'tstamp': (self.START + datetime.timedelta(seconds=i * 397)).isoformat(' ', 'seconds'),
+            'actorasnorg': F'AS{self.random.randrange(self.cardinality) + 1000} Some Hosting Provider Ltd.',
+            'actorcity': self._pick('City '),
+            'actorcountrycode': self.random.choice(['DE', 'US', 'RU', 'CN', 'NL']),
+            'actorhostname': 'NA',
+            'actorip': F'198.51.100.{self.random.randrange(self.cardinality)}',
+            'actorloc': F'{self.random.randrange(-90, 90)}.1234,{self.random.randrange(-180, 180)}.5678',
+            'actorregion': self._pick('Region '),
+            'actortimezone': self.random.choice(['Europe/Berlin', 'America/New_York', 'Asia/Shanghai']),
+            'c2': F'http://{self._pick("c2-")}.example.com/gate.php',
+            'c2asnorg': F'AS{self.random.randrange(self.cardinality) + 2000} Bulletproof Hosting',
+            'c2city': self._pick('City '),
+            'c2countrycode': self.random.choice(['DE', 'US', 'RU', 'CN', 'NL']),
+            'c2domain': F'{self._pick("c2-")}.example.com',
+            'c2domainresolved': F'203.0.113.{self.random.randrange(self.cardinality)}',
+            'c2hostname': 'NA',
+            'c2loc': 'NA' if i % 3 else F'{self.random.randrange(-90, 90)}.4321,{self.random.randrange(180)}.8765',
+            'c2region': 'NA',
+            'c2timezone': 'NA',
+            'cookie_id': F'cookie{self.random.randrange(self.cardinality):026}',
+            'useragent': F'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/{self._pick("")}.0',
+            'tags': 'NA' if i % 2 else self._pick('tag'),
+        }
+
+    def body(self, count: int) -> bytes:
+        return json.dumps([self.line(i) for i in range(count)]).encode('utf-8')
+
+
+class MockMalBeaconServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the MalBeacon API serving synthetic beacons on all `/c2/<endpoint>/<value>` paths. Every value
+    deterministically yields between `min_size` and `max_size` beacons. Responses can be delayed by `latency` seconds
+    and fail at the given rates with "No Results" (400), Unauthorized (401), RequestExceedQuota (429) or a server
+    error (500). If `api_key` is set, requests with another key are rejected as unauthorized.
+    """
+    daemon_threads = True
+    ENDPOINTS = {
+        'cookie_id', 'c2ip', 'c2', 'c2city', 'c2country', 'c2asnorg', 'actorip', 'actorhostname', 'actorcity',
+        'actorcountrycode', 'actorasnorg', 'useragent', 'tags',
+    }
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, min_size: int = 10, max_size: int = 100,
+                 latency: float = 0, no_results_rate: float = 0, unauthorized_rate: float = 0,
+                 quota_rate: float = 0, server_error_rate: float = 0, api_key: str = None, seed: int = 0):
+        super().__init__((host, port), MockMalBeaconRequestHandler)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.latency = latency
+        self.no_results_rate = no_results_rate
+        self.unauthorized_rate = unauthorized_rate
+        self.quota_rate = quota_rate
+        self.server_error_rate = server_error_rate
+        self.api_key = api_key
+        self.seed = seed
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._bodies = collections.OrderedDict()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return F'http://{host}:{port}'
+
+    def body(self, path: str) -> bytes:
+        with self._lock:
+            if path in self._bodies:
+                self._bodies.move_to_end(path)
+                return self._bodies[path]
+        seed = zlib.crc32(path.encode('utf-8')) ^ self.seed
+        size = random.Random(seed).randint(self.min_size, self.max_size)
+        body = SyntheticBeacons(seed).body(size)
+        with self._lock:
+            self._bodies[path] = body
+            while len(self._bodies) > 256:
+                self._bodies.popitem(last=False)
+        return body
+
+    def outcome(self) -> typing.Optional[int]:
+        """Draws the error status of the next response, None for a successful one."""
+        with self._lock:
+            self.requests += 1
+            draw = self._random.random()
+        for status, rate in (
+                (400, self.no_results_rate), (401, self.unauthorized_rate), (429, self.quota_rate),
+                (500, self.server_error_rate)
+        ):
+            if draw < rate:
+                return status
+            draw -= rate
+        return None
+
+    def start(self) -> 'MockMalBeaconServer':
+        """Serves requests on a background thread until `stop` is called."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class MockMalBeaconRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    ERRORS = {
+        400: 'ERROR: No Results',
+        401: 'ERROR: Unauthorized',
+        429: 'ERROR: RequestExceedQuota',
+        500: 'ERROR: Internal Server Error',
+    }
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, headers: typing.Dict[str, str] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int):
+        self._send(
+            status, json.dumps({'message': self.ERRORS[status]}).encode('utf-8'),
+            {'Retry-After': '1'} if status == 429 else None
+        )
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        # paths look like "[/v1]/c2/<endpoint>/<value>", where values such as C2 URLs may contain slashes
+        _, _, path = self.path.partition('/c2/')
+        endpoint, _, value = path.partition('/')
+        if endpoint not in server.ENDPOINTS or not value:
+            self._send_error(400)
+            return
+        if server.api_key is not None and self.headers.get('X-Api-Key') != server.api_key:
+            self._send_error(401)
+            return
+        status = server.outcome()
+        if status is not None:
+            self._send_error(status)
+            return
+        self._send(200, server.body(F'/c2/{endpoint}/{url_unquote(value)}'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic beacons on a local stand-in of the MalBeacon API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--min-size', type=int, default=10, help='Minimum number of beacons per response.')
+    parser.add_argument('--max-size', type=int, default=100, help='Maximum number of beacons per response.')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds to delay every response.')
+    parser.add_argument('--no-results-rate', type=float, default=0)
+    parser.add_argument('--unauthorized-rate', type=float, default=0)
+    parser.add_argument('--quota-rate', type=float, default=0)
+    parser.add_argument('--server-error-rate', type=float, default=0)
+    parser.add_argument('--api-key', help='Reject requests with any other API key.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockMalBeaconServer(
+        args.host, args.port, min_size=args.min_size, max_size=args.max_size, latency=args.latency,
+        no_results_rate=args.no_results_rate, unauthorized_rate=args.unauthorized_rate, quota_rate=args.quota_rate,
+        server_error_rate=args.server_error_rate, api_key=args.api_key, seed=args.seed,
+    )
+    print(F'Serving on {server.base_url}, use --base-url {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import json
+import random
+import typing
+import unittest
+
+from malbeacon import JsonArrayStream, MalBeaconParsingException
+
+
+def chunked(data: bytes, boundaries: typing.Iterable[int]) -> typing.List[bytes]:
+    boundaries = [0] + sorted(set(boundaries)) + [len(data)]
+    return [data[start:end] for start, end in zip(boundaries, boundaries[1:])]
+
+
+class JsonArrayStreamTest(unittest.TestCase):
+    DOCUMENT = [
+        1, 23, 4500.0, -7, 1e-05, 2.5E+10, True, False, None, 'text with , and ]', 'héllo ☃', {'a': [1, {}]},
+        [], [1, [2, [3]]], {'tstamp': '2020-01-01 00:00:00', 'cookie_id': 'x'}, 0, -0.25,
+    ]
+
+    def elements(self, chunks: typing.Iterable[bytes]) -> list:
+        return list(JsonArrayStream(chunks))
+
+    def test_every_single_split(self):
+        data = json.dumps(self.DOCUMENT, ensure_ascii=False).encode('utf-8')
+        for boundary in range(len(data) + 1):
+            with self.subTest(boundary=boundary):
+                self.assertEqual(self.elements(chunked(data, [boundary])), self.DOCUMENT)
+
+    def test_random_splits(self):
+        randomness = random.Random(0)
+        for data in (json.dumps(self.DOCUMENT).encode('utf-8'), json.dumps(self.DOCUMENT, indent=2).encode('utf-8')):
+            for _ in range(200):
+                boundaries = [randomness.randrange(len(data) + 1) for _ in range(randomness.randrange(1, 20))]
+                self.assertEqual(self.elements(chunked(data, boundaries)), self.DOCUMENT)
+
+    def test_byte_by_byte(self):
+        data = json.dumps(self.DOCUMENT, ensure_ascii=False).encode('utf-8')
+        self.assertEqual(self.elements(data[i:i + 1] for i in range(len(data))), self.DOCUMENT)
+
+    def test_number_split_before_fraction_and_exponent(self):
+        self.assertEqual(self.elements([b'[1, 23, 4500.', b'0, 6]']), [1, 23, 4500.0, 6])
+        self.assertEqual(self.elements([b'[12', b'e3]']), [12e3])
+        self.assertEqual(self.elements([b'[12E', b'-1]']), [12E-1])
+        self.assertEqual(self.elements([b'[-', b'1]']), [-1])
+
+    def test_empty_array(self):
+        self.assertEqual(self.elements([b' [ ', b' ] ']), [])
+
+    def test_errors(self):
+        for chunks in ([b'{"a": 1}'], [b'[1, 2'], [b'[1 2]'], [b'[1, 23x]']):
+            with self.subTest(chunks=chunks), self.assertRaises(MalBeaconParsingException):
+                self.elements(chunks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,4 +8,9 @@ setup(
    author_email='lars@wallenborn.net',
    packages=['malbeacon-api'],
    install_requires=['requests', 'terminaltables'],
+   extras_require={
+      'async': ['aiohttp'],
+      'export': ['pyarrow', 'zstandard'],
+      'http2': ['httpx[http2]'],
+   },
 )